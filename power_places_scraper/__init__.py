@@ -1,4 +1,11 @@
 from power_places_scraper.osm_scraper import run as scrape_osm
 from power_places_scraper.google_scraper import run as scrape_google
+from power_places_scraper.google_scraper import SearchFailedError
+from power_places_scraper.api import (
+    iter_scrape_osm, iter_scrape_google, aiter_scrape_osm,
+    aiter_scrape_google)
 
-__all__ = [scrape_osm, scrape_google]
+__all__ = [
+    "scrape_osm", "scrape_google", "iter_scrape_osm", "iter_scrape_google",
+    "aiter_scrape_osm", "aiter_scrape_google", "SearchFailedError",
+]
@@ -0,0 +1,133 @@
+"""Incremental library interface of the scraper.
+
+The iterators yield the places as soon as they are completed, so storing
+them can overlap with the scraping and only the places in flight are kept
+in memory. Closing an iterator (or cancelling the task that consumes an
+async iterator) stops the scraping.
+"""
+
+import asyncio
+import inspect
+import threading
+
+from power_places_scraper import osm_scraper, google_scraper
+
+# maximum number of places buffered between the scraping thread and the
+# consumer of an async iterator
+DEFAULT_BUFFER_SIZE = 100
+
+# marks the end of the places in the queue of an async iterator
+_DONE = object()
+
+
+def iter_with_callback(results, callback=None):
+    """Call callback for every result before yielding it."""
+    try:
+        for result in results:
+            if callback is not None:
+                callback(result)
+            yield result
+    finally:
+        results.close()
+
+
+async def iter_async(results, callback=None,
+                     buffer_size=DEFAULT_BUFFER_SIZE):
+    """Consume a generator in a thread and yield its results.
+
+    :param results: generator (blocking), it is closed in its thread when
+        the async iterator is closed
+    :param callback: optional function called with every result (its result
+        is awaited if it is awaitable)
+    :param buffer_size: maximum number of results that have not been
+        consumed yet (the generator is paused while the buffer is full)
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    slots = threading.Semaphore(buffer_size)
+    cancelled = threading.Event()
+
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(items.put_nowait, item)
+        except RuntimeError:
+            # the event loop is closed already
+            pass
+
+    def produce():
+        try:
+            for item in results:
+                while not slots.acquire(timeout=0.1):
+                    if cancelled.is_set():
+                        return
+                if cancelled.is_set():
+                    return
+                put(item)
+        except Exception as e:
+            put(e)
+        finally:
+            results.close()
+            put(_DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    try:
+        while True:
+            item = await items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            slots.release()
+            if callback is not None:
+                called = callback(item)
+                if inspect.isawaitable(called):
+                    await called
+            yield item
+    finally:
+        cancelled.set()
+
+
+def iter_scrape_osm(bounding_box, callback=None, **params):
+    """Yield the places in a bounding box as their areas are completed.
+
+    :param callback: optional function called with every place
+    :param params: parameters of the scraper (see osm_scraper.OsmScraper)
+    :return: generator of places
+    """
+    return iter_with_callback(osm_scraper.iter_run(bounding_box, **params),
+                              callback)
+
+
+def iter_scrape_google(places, callback=None, **params):
+    """Yield the google results of places as they are completed.
+
+    :param callback: optional function called with every result
+    :param params: parameters of the searches (see google_scraper.iter_run)
+    :return: generator of dicts with the osm and google information
+    :raises google_scraper.SearchFailedError: if a search failed
+    """
+    return iter_with_callback(google_scraper.iter_run(places, **params),
+                              callback)
+
+
+def aiter_scrape_osm(bounding_box, callback=None,
+                     buffer_size=DEFAULT_BUFFER_SIZE, **params):
+    """Asynchronously yield the places in a bounding box (see iter_async).
+
+    The queries run in a background thread.
+    """
+    return iter_async(osm_scraper.iter_run(bounding_box, **params),
+                      callback=callback, buffer_size=buffer_size)
+
+
+def aiter_scrape_google(places, callback=None,
+                        buffer_size=DEFAULT_BUFFER_SIZE, **params):
+    """Asynchronously yield the google results of places (see iter_async).
+
+    The searches run in a background thread (with the given engine).
+
+    :raises google_scraper.SearchFailedError: if a search failed
+    """
+    return iter_async(google_scraper.iter_run(places, **params),
+                      callback=callback, buffer_size=buffer_size)
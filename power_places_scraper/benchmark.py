@@ -0,0 +1,620 @@
+"""Offline benchmark of the OSM and google scraping.
+
+Local stand-in servers replay (recorded or synthetic) Overpass and google
+search responses with a configurable latency, error rate and rate of
+throttled (429) responses. Both stages are run end to end against them at
+several concurrency levels, each run in a fresh process:
+
+    python -m power_places_scraper.benchmark --levels 1,8,32
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import random
+import re
+import resource
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote_plus
+
+from power_places_scraper.osm_scraper import OsmScraper
+from power_places_scraper.google_scraper import iter_run as scrape_google_iter
+from power_places_scraper.cache import ResponseCache
+from power_places_scraper.limiter import AdaptiveLimiter
+
+
+# bounding box of the synthetic places (berlin mitte)
+DEFAULT_BOUNDING_BOX = ((52.50, 13.36), (52.54, 13.42))
+
+STREETS = ["Hauptstraße", "Bahnhofstraße", "Gartenstraße", "Schulstraße",
+           "Dorfstraße", "Kirchweg", "Lindenallee", "Parkstraße"]
+
+
+def synthetic_elements(num_places, bounding_box=DEFAULT_BOUNDING_BOX, seed=0):
+    """Return Overpass json elements of random places in a bounding box."""
+    rnd = random.Random(seed)
+    (min_lat, min_lng), (max_lat, max_lng) = bounding_box
+
+    elements = list()
+    for i in range(num_places):
+        lat = rnd.uniform(min_lat, max_lat)
+        lng = rnd.uniform(min_lng, max_lng)
+        tags = {
+            "name": "Place {}".format(i),
+            "addr:street": rnd.choice(STREETS),
+            "addr:housenumber": str(rnd.randint(1, 200)),
+        }
+        if i % 4 == 0:
+            elements.append(dict(type="way", id=i, center=dict(
+                lat=lat, lon=lng), nodes=[], tags=tags))
+        else:
+            elements.append(dict(type="node", id=i, lat=lat, lon=lng,
+                                 tags=tags))
+    return elements
+
+
+def element_position(element):
+    """Return the position of an Overpass json element."""
+    if element["type"] == "way":
+        return element["center"]["lat"], element["center"]["lon"]
+    return element["lat"], element["lon"]
+
+
+def synthetic_search_response(search_string):
+    """Return a search response body (in the format of the google search).
+
+    The content only depends on the search string.
+    """
+    rnd = random.Random(hashlib.sha1(search_string.encode()).hexdigest())
+
+    info = [None] * 118
+    info[2] = search_string
+    info[3] = ["+49 30 {}".format(rnd.randint(100000, 999999))]
+    rating = [None] * 9
+    rating[7] = round(rnd.uniform(1, 5), 1)
+    rating[8] = rnd.randint(1, 1000)
+    info[4] = rating
+    info[7] = [None, "https://example.com/{}".format(rnd.randint(0, 10**6))]
+    info[9] = [None, None, rnd.uniform(52.5, 52.54), rnd.uniform(13.36, 13.42)]
+    info[11] = search_string.split(" ")[0]
+    info[27] = "https://www.google.de/maps/place/{}".format(rnd.randint(
+        0, 10**9))
+    info[76] = [["restaurant"], ["food"]]
+    info[78] = "ChIJ{:016x}".format(rnd.getrandbits(64))
+
+    if rnd.random() < 0.5:
+        days = [
+            [day, [[hour, rnd.randint(0, 100), None,
+                    "{} min".format(rnd.randint(0, 30)), None, None]
+                   for hour in range(6, 24)]]
+            for day in range(1, 8)
+        ]
+        current = [None] * 8
+        current[7] = [None, rnd.randint(0, 100)]
+        info[84] = [days] + current[1:]
+        info[117] = ["People typically spend 15 min to 1 hr here"]
+
+    data = [[None, [[None] * 14 + [info]]]]
+    return json.dumps({"d": ")]}'\n" + json.dumps(data)}) + '/*""*/'
+
+
+class FaultInjection:
+    """Latency and faults of a stand-in server."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, throttle_rate=0.0,
+                 error_status=500, seed=0):
+        """Initialize the faults.
+
+        :param latency: seconds until a response is sent
+        :param error_rate: share of requests answered with an error
+        :param throttle_rate: share of requests answered with 429
+        :param error_status: status of the injected errors
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def fault(self):
+        """Wait for the latency and return the status of an injected fault.
+
+        :return: 429, 5xx or None if the request should succeed
+        """
+        time.sleep(self.latency)
+        with self.lock:
+            r = self.random.random()
+        if r < self.throttle_rate:
+            return 429
+        if r < self.throttle_rate + self.error_rate:
+            return self.error_status
+        return None
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Threaded http server on a free local port."""
+
+    daemon_threads = True
+
+    def __init__(self, handler, faults):
+        """Start listening on a free port."""
+        super().__init__(("127.0.0.1", 0), handler)
+        self.faults = faults
+        self.lock = threading.Lock()
+        self.num_requests = 0
+
+    def count_request(self):
+        """Count a request."""
+        with self.lock:
+            self.num_requests += 1
+
+    @property
+    def base_url(self):
+        """Return the url of the server."""
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def start(self):
+        """Serve in a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Common functionality of the request handlers."""
+
+    def log_message(self, format, *args):
+        """Do not log requests."""
+
+    def send_body(self, status, body, content_type="text/plain"):
+        """Send a response."""
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_fault(self):
+        """Send an injected fault, return False if there is none."""
+        self.server.count_request()
+        status = self.server.faults.fault()
+        if status is None:
+            return False
+        self.send_body(status, "injected fault")
+        return True
+
+
+class GoogleHandler(StandInHandler):
+    """Answer searches with recorded or synthetic responses."""
+
+    def do_GET(self):
+        """Answer a search."""
+        params = parse_qs(urlparse(self.path).query)
+        search_string = params.get("q", [""])[0]
+        self.server.record_arrival(search_string)
+
+        if self.send_fault():
+            return
+
+        body = None
+        if self.server.recorded is not None:
+            body = self.server.recorded.get(
+                dict(q=search_string, hl=params["hl"][0],
+                     pb=params["pb"][0]))
+        if body is None:
+            body = synthetic_search_response(search_string)
+
+        self.send_body(200, body, "application/json; charset=UTF-8")
+
+
+class GoogleServer(StandInServer):
+    """Stand-in for the google search."""
+
+    def __init__(self, faults, recorded=None):
+        """Initialize the server.
+
+        :param recorded: optional ResponseCache with recorded responses
+        """
+        super().__init__(GoogleHandler, faults)
+        self.recorded = recorded
+        self.first_arrival = dict()
+
+    def record_arrival(self, search_string):
+        """Remember when a search string has been requested first."""
+        with self.lock:
+            self.first_arrival.setdefault(search_string, time.time())
+
+    @property
+    def url(self):
+        """Return the url of the search."""
+        return self.base_url + "/search"
+
+
+class OverpassHandler(StandInHandler):
+    """Answer Overpass queries with the elements in their bounding box."""
+
+    # a bounding box filter or the global bounding box of the query
+    bbox_pattern = re.compile(
+        r"(?:\(|\[bbox:)(-?[\d.]+),(-?[\d.]+),(-?[\d.]+),(-?[\d.]+)[)\]]")
+    limit_pattern = re.compile(r"out center (\d+);")
+
+    def do_GET(self):
+        """Answer a status request."""
+        if self.path.startswith("/api/status"):
+            # a rate limit of 0 means there is no limit
+            self.send_body(200, "Connected as: 0\nRate limit: 0\n")
+        else:
+            self.send_body(404, "not found")
+
+    def do_POST(self):
+        """Answer a query."""
+        length = int(self.headers.get("Content-Length", 0))
+        query = self.rfile.read(length).decode("utf-8")
+        if query.startswith("data="):
+            query = unquote_plus(query[5:])
+
+        if self.send_fault():
+            return
+
+        bbox = self.bbox_pattern.search(query)
+        min_lat, min_lng, max_lat, max_lng = map(float, bbox.groups())
+
+        elements = [
+            e for e in self.server.elements
+            if min_lat <= element_position(e)[0] < max_lat
+            and min_lng <= element_position(e)[1] < max_lng
+        ]
+
+        limit = self.limit_pattern.search(query)
+        if limit is not None:
+            elements = elements[:int(limit.group(1))]
+
+        self.send_body(200, json.dumps(dict(version=0.6, elements=elements)),
+                       "application/json")
+
+
+class OverpassServer(StandInServer):
+    """Stand-in for the Overpass API."""
+
+    def __init__(self, faults, elements):
+        """Initialize the server with the elements of its database."""
+        super().__init__(OverpassHandler, faults)
+        self.elements = elements
+
+    @property
+    def url(self):
+        """Return the url of the interpreter."""
+        return self.base_url + "/api/interpreter"
+
+
+def element_places(elements):
+    """Convert Overpass json elements into places (like the OsmScraper)."""
+    return [
+        dict(zip(("lat", "lng"), element_position(e)),
+             id="{}/{}".format(e["type"], e["id"]), tags=e["tags"])
+        for e in elements
+    ]
+
+
+def percentile(values, p):
+    """Return the p-th percentile of values (nearest rank)."""
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def usage():
+    """Return cpu seconds and peak rss (MB) of this process and children."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (own.ru_utime + own.ru_stime
+           + children.ru_utime + children.ru_stime)
+    # ru_maxrss is in kilobytes on linux
+    rss = max(own.ru_maxrss, children.ru_maxrss) / 1024
+    return cpu, rss
+
+
+class TimedOsmScraper(OsmScraper):
+    """OsmScraper that keeps the latencies of its queries (with retries)."""
+
+    def __init__(self, **params):
+        """Initialize the scraper (see OsmScraper)."""
+        super().__init__(**params)
+        self.latencies = list()
+
+    def query_area(self, *args):
+        """Query an area and keep the latency."""
+        start = time.perf_counter()
+        result = super().query_area(*args)
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+
+def run_osm_stage(level, url, bounding_box, params):
+    """Run the OSM scraping, return its number of places and latencies."""
+    scraper = TimedOsmScraper(url=url, workers=level, **params)
+    places = scraper.run(bounding_box)
+    return len(places), scraper.latencies
+
+
+def run_google_stage(level, url, places, params):
+    """Run the google scraping, return its number of places and yield times.
+
+    The yield times (by search string) are compared with the first arrival
+    of the search string at the server.
+    """
+    params = dict(params)
+    if params.get("engine", "pool") == "pool":
+        params["num_processes"] = level
+    else:
+        params["concurrency"] = level
+
+    if params.pop("adaptive_concurrency", False):
+        params["limiter"] = AdaptiveLimiter(max_limit=level)
+
+    completed = dict()
+    num_places = 0
+    for place in scrape_google_iter(places, search_url=url, **params):
+        search_string = place["google"]["search_info"]["search_string"]
+        completed.setdefault(search_string, time.time())
+        num_places += 1
+    return num_places, completed
+
+
+def measure(stage_func, args, results):
+    """Run a stage in this (child) process and put its measurements.
+
+    If the stage fails, the formatted exception is put instead.
+    """
+    # hide the progress bars of the scrapers (only while the stage runs, so
+    # errors are still shown)
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, "w")
+
+    try:
+        cpu_before, _ = usage()
+        start = time.perf_counter()
+        num_places, latencies = stage_func(*args)
+        duration = time.perf_counter() - start
+        cpu, rss = usage()
+    except BaseException:
+        sys.stderr = stderr
+        results.put(dict(error=traceback.format_exc()))
+        return
+    finally:
+        sys.stderr = stderr
+
+    results.put(dict(num_places=num_places, latencies=latencies,
+                     duration=duration, cpu=cpu - cpu_before, peak_rss=rss))
+
+
+def run_measured(stage_func, *args):
+    """Run a stage in a fresh process and return its measurements.
+
+    :raises RuntimeError: if the stage fails (or its process dies)
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure,
+                                      args=(stage_func, args, results))
+    process.start()
+    measurement = None
+    while measurement is None:
+        # check whether the process has exited before waiting, so its last
+        # measurement is still read
+        alive = process.is_alive()
+        try:
+            measurement = results.get(timeout=1)
+        except queue.Empty:
+            if not alive:
+                raise RuntimeError(
+                    "The benchmark process died (exit code {}).".format(
+                        process.exitcode))
+    process.join()
+    if "error" in measurement:
+        raise RuntimeError("The benchmark stage failed:\n{}".format(
+            measurement["error"]))
+    return measurement
+
+
+def report_row(stage, level, measurement, num_requests):
+    """Return the report of a run of a stage."""
+    latencies = measurement["latencies"]
+    return dict(
+        stage=stage,
+        level=level,
+        places=measurement["num_places"],
+        requests=num_requests,
+        seconds=measurement["duration"],
+        places_per_sec=measurement["num_places"] / measurement["duration"],
+        p50=percentile(latencies, 50),
+        p99=percentile(latencies, 99),
+        cpu_seconds=measurement["cpu"],
+        peak_rss_mb=measurement["peak_rss"],
+    )
+
+
+def format_report(rows):
+    """Return the report as a table."""
+    columns = ["stage", "level", "places", "requests", "seconds",
+               "places_per_sec", "p50", "p99", "cpu_seconds", "peak_rss_mb"]
+    lines = ["\t".join(columns)]
+    for row in rows:
+        lines.append("\t".join(
+            "-" if row[c] is None else
+            "{:.3f}".format(row[c]) if isinstance(row[c], float) else
+            str(row[c]) for c in columns))
+    return "\n".join(lines)
+
+
+def run(levels=(1, 8, 32), num_places=1000, stages=("osm", "google"),
+        google_faults=None, overpass_faults=None, elements=None,
+        recorded=None, osm_params=None, google_params=None):
+    """Run the benchmark and return a report row per stage and level.
+
+    :param levels: concurrency levels (workers of the OSM scraping, processes
+        or concurrency of the google scraping depending on the engine)
+    :param num_places: number of synthetic places (if elements is not set)
+    :param google_faults: FaultInjection of the google stand-in
+    :param overpass_faults: FaultInjection of the Overpass stand-in
+    :param elements: Overpass json elements (e.g. of a recorded response)
+    :param recorded: ResponseCache with recorded google responses
+    :param osm_params: further parameters of the OSM scraping
+    :param google_params: further parameters of the google scraping
+    :return: list of dicts (see report_row)
+    """
+    if elements is None:
+        elements = synthetic_elements(num_places)
+    osm_params = osm_params or dict()
+    google_params = google_params or dict()
+
+    positions = [element_position(e) for e in elements]
+    bounding_box = (
+        (min(p[0] for p in positions), min(p[1] for p in positions)),
+        # the upper bounds of the sub areas are exclusive
+        (max(p[0] for p in positions) + 1e-6,
+         max(p[1] for p in positions) + 1e-6),
+    )
+    places = element_places(elements)
+
+    overpass = OverpassServer(overpass_faults or FaultInjection(),
+                              elements).start()
+    google = GoogleServer(google_faults or FaultInjection(),
+                          recorded=recorded).start()
+
+    rows = list()
+    for level in levels:
+        if "osm" in stages:
+            before = overpass.num_requests
+            measurement = run_measured(run_osm_stage, level, overpass.url,
+                                       bounding_box, osm_params)
+            rows.append(report_row("osm", level, measurement,
+                                   overpass.num_requests - before))
+
+        if "google" in stages:
+            before = google.num_requests
+            google.first_arrival.clear()
+            measurement = run_measured(run_google_stage, level, google.url,
+                                       places, google_params)
+            completed = measurement["latencies"]
+            measurement["latencies"] = [
+                completed[s] - google.first_arrival[s]
+                for s in completed if s in google.first_arrival
+            ]
+            rows.append(report_row("google", level, measurement,
+                                   google.num_requests - before))
+
+    overpass.shutdown()
+    google.shutdown()
+    return rows
+
+
+def parse_args(args):
+    """Parse commandline arguments."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the scraping against local stand-in servers.")
+
+    parser.add_argument('--levels', help="Comma separated concurrency levels "
+                        "(default: 1,8,32).", default="1,8,32",
+                        dest="levels")
+
+    parser.add_argument('--stages', help="Comma separated stages to run "
+                        "(default: osm,google).", default="osm,google",
+                        dest="stages")
+
+    parser.add_argument('--places', help="Number of synthetic places "
+                        "(default: 1000).", type=int, default=1000,
+                        dest="num_places")
+
+    parser.add_argument('--overpass-response', help="Recorded Overpass json "
+                        "response used instead of synthetic places.",
+                        default=None, dest="overpass_response")
+
+    parser.add_argument('--google-responses', help="Cache (see --cache of "
+                        "the scraper) with recorded google responses, "
+                        "missing searches are answered with synthetic "
+                        "responses.", default=None, dest="google_responses")
+
+    for name in ("google", "overpass"):
+        parser.add_argument('--{}-latency'.format(name), help="Seconds until "
+                            "the {} stand-in responds.".format(name),
+                            type=float, default=0.05,
+                            dest="{}_latency".format(name))
+        parser.add_argument('--{}-error-rate'.format(name), help="Share of "
+                            "requests answered with an error.", type=float,
+                            default=0.0, dest="{}_error_rate".format(name))
+        parser.add_argument('--{}-429-rate'.format(name), help="Share of "
+                            "requests answered with 429 (too many requests).",
+                            type=float, default=0.0,
+                            dest="{}_throttle_rate".format(name))
+
+    parser.add_argument('--engine', help="Engine of the google scraping.",
+                        default="pool", choices=["pool", "asyncio",
+                                                 "pipeline"], dest="engine")
+
+    parser.add_argument('--adaptive-concurrency', help="Adapt the "
+                        "concurrency of the google scraping (the level is "
+                        "the maximum).", action='store_true',
+                        dest="adaptive_concurrency")
+
+    parser.add_argument('--adaptive', help="Split the Overpass area "
+                        "adaptively.", action='store_true', dest="adaptive")
+
+    parser.add_argument('--output', help="Save the report as json.",
+                        default=None, dest="output")
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    """Run the benchmark using cli arguments."""
+    args = parse_args(sys.argv[1:] if args is None else args)
+
+    elements = None
+    if args.overpass_response is not None:
+        with open(args.overpass_response, 'r') as f:
+            elements = [e for e in json.load(f)["elements"]
+                        if e["type"] == "node" or "center" in e]
+
+    recorded = None
+    if args.google_responses is not None:
+        recorded = ResponseCache(args.google_responses, offline=True)
+
+    google_faults = FaultInjection(args.google_latency, args.google_error_rate,
+                                   args.google_throttle_rate)
+    # the Overpass scraper retries gateway timeouts
+    overpass_faults = FaultInjection(
+        args.overpass_latency, args.overpass_error_rate,
+        args.overpass_throttle_rate, error_status=504)
+
+    rows = run(
+        levels=[int(level) for level in args.levels.split(",")],
+        num_places=args.num_places,
+        stages=args.stages.split(","),
+        google_faults=google_faults,
+        overpass_faults=overpass_faults,
+        elements=elements,
+        recorded=recorded,
+        osm_params=dict(adaptive=args.adaptive),
+        google_params=dict(engine=args.engine,
+                           adaptive_concurrency=args.adaptive_concurrency),
+    )
+
+    print(format_report(rows))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""Persistent on-disk caches for the google search and the Overpass API."""
+
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# static fields (rating, types, popular times) only change slowly
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+# shops and restaurants change even more slowly on OSM
+DEFAULT_TILE_TTL = 30 * 24 * 60 * 60
+
+# marks a tile with too many elements for a single query (its four child
+# tiles are queried instead)
+TILE_SPLIT = "split"
+
+# number of insertions between two checks of the total cache size
+EVICTION_INTERVAL = 100
+
+# connections are opened lazily and once per process (the cache object is
+# pickled when it is passed to the workers of a process pool), the threads
+# of a process share the connection behind a lock
+_connections = dict()
+_num_insertions = collections.Counter()
+_connections_lock = threading.Lock()
+
+
+class SqliteCache:
+    """Base of the caches, a table in a sqlite database."""
+
+    # statements creating the table (and its indexes)
+    schema = ()
+
+    def __init__(self, path):
+        """Initialize the cache with the path of the sqlite database."""
+        self.path = path
+
+    @property
+    def connection(self):
+        """Return the connection of the current process and its lock."""
+        key = self._process_key
+        with _connections_lock:
+            if key not in _connections:
+                connection = sqlite3.connect(self.path, timeout=60,
+                                             isolation_level=None,
+                                             check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                for statement in self.schema:
+                    connection.execute(statement)
+                _connections[key] = (connection, threading.Lock())
+            return _connections[key]
+
+    def execute(self, sql, parameters=()):
+        """Execute a statement and return all rows of its result."""
+        connection, lock = self.connection
+        with lock:
+            return connection.execute(sql, parameters).fetchall()
+
+    def executemany(self, sql, seq_of_parameters):
+        """Execute a statement for every set of parameters."""
+        connection, lock = self.connection
+        with lock:
+            connection.executemany(sql, seq_of_parameters)
+
+    @property
+    def _process_key(self):
+        """Return the key of the connection of the current process."""
+        return os.getpid(), self.path, type(self).__name__
+
+
+class ResponseCache(SqliteCache):
+    """Cache raw response bodies in a sqlite database.
+
+    Entries are stored under the search string and the hl/pb parameters of
+    the search, so changing the parsing code does not invalidate them.
+    """
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS responses ("
+        "search_string TEXT NOT NULL, "
+        "hl TEXT NOT NULL, "
+        "pb_hash TEXT NOT NULL, "
+        "body TEXT NOT NULL, "
+        "size INTEGER NOT NULL, "
+        "created REAL NOT NULL, "
+        "expires REAL NOT NULL, "
+        "accessed REAL NOT NULL, "
+        "PRIMARY KEY (search_string, hl, pb_hash))",
+        "CREATE INDEX IF NOT EXISTS responses_accessed "
+        "ON responses (accessed)",
+    )
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_size=None, offline=False):
+        """Initialize the cache.
+
+        :param path: path of the sqlite database
+        :param ttl: default time to live of an entry in seconds
+        :param max_size: maximum total size of all bodies in bytes (least
+            recently used entries are evicted first)
+        :param offline: only read from the cache, never request google
+        """
+        super().__init__(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+
+    @staticmethod
+    def key(params):
+        """Return the key of an entry for the parameters of a search."""
+        pb_hash = hashlib.sha1(params['pb'].encode()).hexdigest()
+        return params['q'], params['hl'], pb_hash
+
+    def get(self, params):
+        """Return the cached body for a search or None if not available."""
+        now = time.time()
+        rows = self.execute(
+            "SELECT body FROM responses WHERE search_string=? AND hl=? "
+            "AND pb_hash=? AND expires>?", self.key(params) + (now,))
+
+        if not rows:
+            return None
+
+        self.execute(
+            "UPDATE responses SET accessed=? WHERE search_string=? AND hl=? "
+            "AND pb_hash=?", (now,) + self.key(params))
+
+        return rows[0][0]
+
+    def put(self, params, body, ttl=None):
+        """Store the body of a search response."""
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+
+        # the size is counted in bytes (like max_size), not characters
+        self.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            self.key(params) + (body, len(body.encode()), now, now + ttl,
+                                now))
+
+        _num_insertions[self._process_key] += 1
+        if _num_insertions[self._process_key] % EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def size(self):
+        """Return the total size of all cached bodies."""
+        return self.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses")[0][0]
+
+    def evict(self):
+        """Remove expired entries and shrink the cache to its maximum size."""
+        self.execute(
+            "DELETE FROM responses WHERE expires<=?", (time.time(),))
+
+        if self.max_size is None:
+            return
+
+        excess = self.size() - self.max_size
+        if excess <= 0:
+            return
+
+        # remove least recently used entries until the excess is covered
+        rows = self.execute(
+            "SELECT search_string, hl, pb_hash, size FROM responses "
+            "ORDER BY accessed")
+        keys = list()
+        for search_string, hl, pb_hash, size in rows:
+            if excess <= 0:
+                break
+            keys.append((search_string, hl, pb_hash))
+            excess -= size
+
+        self.executemany(
+            "DELETE FROM responses WHERE search_string=? AND hl=? "
+            "AND pb_hash=?", keys)
+
+
+class TileCache(SqliteCache):
+    """Cache the elements of Overpass queries per map tile.
+
+    Entries are stored under a key of the tag filters and the (slippy map)
+    tile, so overlapping areas only query the tiles that are not cached yet.
+    The elements of a tile are stored as records (see osm_scraper) and
+    include those outside of the queried area, since other areas can share
+    the same tile.
+    """
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS tiles ("
+        "filter_key TEXT NOT NULL, "
+        "zoom INTEGER NOT NULL, "
+        "x INTEGER NOT NULL, "
+        "y INTEGER NOT NULL, "
+        "elements TEXT NOT NULL, "
+        "created REAL NOT NULL, "
+        "expires REAL NOT NULL, "
+        "PRIMARY KEY (filter_key, zoom, x, y))",
+    )
+
+    def __init__(self, path, ttl=DEFAULT_TILE_TTL):
+        """Initialize the cache.
+
+        :param path: path of the sqlite database (can be the same as the one
+            of a ResponseCache)
+        :param ttl: time to live of a tile in seconds
+        """
+        super().__init__(path)
+        self.ttl = ttl
+
+    @staticmethod
+    def filter_key(tag_filters):
+        """Return the key of a set of tag filters (see OsmScraper)."""
+        text = "\n".join(sorted(set(tag_filters)))
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def get(self, filter_key, tile):
+        """Return the cached records of a tile.
+
+        :return: list of records, TILE_SPLIT or None if not available
+        """
+        rows = self.execute(
+            "SELECT elements FROM tiles WHERE filter_key=? AND zoom=? AND "
+            "x=? AND y=? AND expires>?", (filter_key,) + tuple(tile) + (
+                time.time(),))
+
+        if not rows:
+            return None
+        if rows[0][0] == TILE_SPLIT:
+            return TILE_SPLIT
+        return json.loads(rows[0][0])
+
+    def put(self, filter_key, tile, records):
+        """Store the records of a tile (or TILE_SPLIT)."""
+        now = time.time()
+        elements = records if records == TILE_SPLIT else json.dumps(records)
+        self.execute(
+            "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (filter_key,) + tuple(tile) + (elements, now, now + self.ttl))
+
+    def evict(self):
+        """Remove expired tiles."""
+        self.execute(
+            "DELETE FROM tiles WHERE expires<=?", (time.time(),))
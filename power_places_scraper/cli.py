@@ -1,13 +1,37 @@
 import argparse
+import atexit
 import sys
 import os
 import json
+import queue
+import threading
+from concurrent.futures import (
+    ThreadPoolExecutor, wait, FIRST_EXCEPTION)
+from multiprocessing import Pool
 from tqdm import tqdm
 
 from power_places_scraper import scrape_osm, scrape_google
-from power_places_scraper.osm_scraper import DEFAULT_TAG_FILTER_OBJECTS
+from power_places_scraper.google_scraper import (
+    iter_run as scrape_google_iter, iter_deduplicated, collect_updates,
+    merge_updates, SearchFailedError, SEARCH_URL)
+from power_places_scraper.osm_scraper import (
+    DEFAULT_TAG_FILTER_OBJECTS, DEFAULT_TILE_ZOOM)
+from power_places_scraper.cache import ResponseCache, TileCache
+from power_places_scraper.popularity import write_popularity
+from power_places_scraper.places import tag_projection, compact_place
+from power_places_scraper.live import LivePoller
+from power_places_scraper.store import ObservationStore
+from power_places_scraper.limiter import AdaptiveLimiter, NO_LIMIT, share
+from power_places_scraper.proxies import ProxyPool, load_proxies
+from power_places_scraper.metrics import (
+    Metrics, NULL_METRICS, DEFAULT_INTERVAL, JsonLinesSink,
+    PrometheusTextfileSink)
+from power_places_scraper.matching import (
+    match_places, build_index, match_record, DEFAULT_RADIUS)
 from power_places_scraper.util import (
-    load_bounding_box, get_external_ip, current_time_str)
+    load_bounding_box, load_area, get_external_ip, current_time_str,
+    iter_ndjson, write_ndjson, meta_path, load_meta, save_meta,
+    check_proxies)
 
 
 def parse_args(args):
@@ -31,10 +55,75 @@ def parse_args(args):
                                         "format: <host>:<port>",
                         default=None, dest="proxy")
 
+    parser.add_argument('--proxy-file', help="File with a pool of proxies "
+                        "for google requests (one per line, either "
+                        "<host>:<port> for a socks5 proxy or an url like "
+                        "http://<user>:<password>@<host>:<port>). Has "
+                        "precedence over --proxy and --tor.", default=None,
+                        dest="proxy_file")
+
+    parser.add_argument('--proxy-concurrency', help="Maximum number of "
+                        "concurrent google requests per proxy of the "
+                        "--proxy-file (default: 10).", type=int, default=10,
+                        dest="proxy_concurrency")
+
+    parser.add_argument('--proxy-rate', help="Maximum number of google "
+                        "requests per second per proxy of the --proxy-file "
+                        "(default: no limit).", type=float, default=None,
+                        dest="proxy_rate")
+
     parser.add_argument('--tag-filters', help="Use this option to specify"
                         "which elements to query from Overpass.",
                         action='store', default=None, dest="tag_filter_path")
 
+    parser.add_argument('--keep-tags', help="Only keep the tags of the OSM "
+                        "places that are needed for the google search (name "
+                        "and address), their category (amenity, shop, "
+                        "leisure, tourism, office and craft, see "
+                        "--prioritize) and the given tags, e.g. --keep-tags "
+                        "opening_hours website (by default all tags are "
+                        "kept).", nargs='*', default=None, dest="keep_tags")
+
+    parser.add_argument('--adaptive', help="Split the area for the Overpass "
+                        "queries adaptively (depending on the density of "
+                        "places) instead of using a fixed grid.",
+                        action='store_true', dest="adaptive")
+
+    parser.add_argument('--max-elements', help="Maximum number of elements "
+                        "per Overpass query when using --adaptive (default: "
+                        "2000).", type=int, default=2000,
+                        dest="max_elements")
+
+    parser.add_argument('--bounding-box-only', help="Query all places in the"
+                        " bounding box of the area instead of only those "
+                        "within its polygons.", action='store_true',
+                        dest="bounding_box_only")
+
+    parser.add_argument('--osm-workers', help="Number of concurrent Overpass "
+                        "queries (scheduled according to the free slots of "
+                        "the server, default: 1).", type=int, default=1,
+                        dest="osm_workers")
+
+    parser.add_argument('--osm-streaming', help="Parse the responses of "
+                        "Overpass element by element while they are "
+                        "downloaded (uses less memory for large areas).",
+                        action='store_true', dest="osm_streaming")
+
+    parser.add_argument('--osm-cache', help="Path of a sqlite database used "
+                        "to cache the places from Overpass per map tile "
+                        "(overlapping areas only query the tiles that are "
+                        "not cached yet).", default=None,
+                        dest="osm_cache_path")
+
+    parser.add_argument('--osm-cache-ttl', help="Number of days a cached "
+                        "tile is used (default: 30).", type=float,
+                        default=30, dest="osm_cache_ttl")
+
+    parser.add_argument('--tile-zoom', help="Zoom level of the map tiles "
+                        "queried when using --osm-cache (default: {})."
+                        .format(DEFAULT_TILE_ZOOM), type=int,
+                        default=DEFAULT_TILE_ZOOM, dest="tile_zoom")
+
     parser.add_argument('--tor', help="Use default TOR proxy settings (if both"
                         "options are set, --proxy has precedence).",
                         action='store_true', dest="proxy_tor")
@@ -43,16 +132,283 @@ def parse_args(args):
                         "for google search scraping.", type=int, default=40,
                         action='store', dest="num_processes")
 
+    parser.add_argument('--engine', help="Engine used for google search "
+                        "scraping: 'pool' (one process per concurrent search)"
+                        ", 'asyncio' (concurrent searches in a single "
+                        "process, requires aiohttp) or 'pipeline' (fetching "
+                        "in threads, parsing in a separate process pool).",
+                        default="pool", choices=["pool", "asyncio",
+                                                 "pipeline"], dest="engine")
+
+    parser.add_argument('--concurrency', help="Maximum number of concurrent "
+                        "google searches when using the asyncio or pipeline "
+                        "engine.", type=int, default=200, action='store',
+                        dest="concurrency")
+
+    parser.add_argument('--search-url', help="Url of the google search (e.g. "
+                        "of a local test server, recorded in the "
+                        "search_info of the results).", default=SEARCH_URL,
+                        dest="search_url")
+
+    parser.add_argument('--adaptive-concurrency', help="Adapt the number of "
+                        "concurrent google searches: raise it while the "
+                        "searches succeed, cut it when google throttles them"
+                        " (--num-processes or --concurrency is the maximum)."
+                        , action='store_true', dest="adaptive_concurrency")
+
+    parser.add_argument('--min-concurrency', help="Minimum number of "
+                        "concurrent google searches when using "
+                        "--adaptive-concurrency (default: 1).", type=int,
+                        default=1, dest="min_concurrency")
+
+    parser.add_argument('--max-latency', help="Only raise the number of "
+                        "concurrent searches while the responses arrive "
+                        "within this number of seconds (default: 5).",
+                        type=float, default=5.0, dest="max_latency")
+
+    parser.add_argument('--max-rate', help="Maximum number of google "
+                        "requests per second (default: no limit).",
+                        type=float, default=None, dest="max_rate")
+
+    parser.add_argument('--parse-processes', help="Number of processes for "
+                        "parsing the responses when using the pipeline "
+                        "engine (default: number of cpus).", type=int,
+                        default=None, dest="parse_processes")
+
+    parser.add_argument('--cache', help="Path of a sqlite database used to "
+                        "cache the responses of the google search.",
+                        default=None, dest="cache_path")
+
+    parser.add_argument('--cache-ttl', help="Number of days a cached google "
+                        "response is used (default: 7).", type=float,
+                        default=7, dest="cache_ttl")
+
+    parser.add_argument('--cache-max-size', help="Maximum size of the cache "
+                        "in MB (least recently used responses are removed "
+                        "first).", type=float, default=None,
+                        dest="cache_max_size")
+
+    parser.add_argument('--offline', help="Only use cached google responses "
+                        "(requires --cache).", action='store_true',
+                        dest="offline")
+
+    parser.add_argument('--ndjson', help="Stream places from and to "
+                        "line-delimited json files (one place per line, the "
+                        "metadata of the run is saved in <target>.meta.json)."
+                        , action='store_true', dest="ndjson")
+
+    parser.add_argument('--no-search-grouping', help="Search every place "
+                        "separately, even if several places have the same "
+                        "search string (the default with --ndjson, since "
+                        "grouping reads all places into memory before the "
+                        "first search).", action='store_false', default=None,
+                        dest="group_searches")
+
+    parser.add_argument('--search-grouping', help="Search places with the "
+                        "same search string only once, also with --ndjson "
+                        "(all places are read into memory first).",
+                        action='store_true', default=None,
+                        dest="group_searches")
+
+    parser.add_argument('--prioritize', help="Search the places in the "
+                        "order of their expected value (estimated from their "
+                        "tags and the hit rates of the run).",
+                        action='store_true', dest="prioritize")
+
+    parser.add_argument('--budget', help="Maximum number of google searches"
+                        " (with --prioritize the places with the highest "
+                        "expected value are searched).", type=int,
+                        default=None, dest="budget")
+
+    parser.add_argument('--compact-popularity', help="Save popular and "
+                        "waiting times as flat lists of 7 * 24 values "
+                        "(monday 0:00 first) instead of lists of days.",
+                        action='store_true', dest="compact_popularity")
+
+    parser.add_argument('--export-popularity', help="Export the popular and "
+                        "waiting times of all places into the binary file "
+                        "<target>.popularity.", action='store_true',
+                        dest="export_popularity")
+
+    parser.add_argument('--deduplicate', help="Merge places that resolve to "
+                        "the same google place (the OSM places of the "
+                        "duplicates are kept in 'osm_duplicates'). With "
+                        "--ndjson, duplicates are streamed as update "
+                        "records that are merged at the end.",
+                        action='store_true', dest="deduplicate")
+
+    parser.add_argument('--match', help="Match the OSM places with the "
+                        "google places nearby and add a match confidence to"
+                        " every place.", action='store_true', dest="match")
+
+    parser.add_argument('--match-radius', help="Maximum distance (in meters)"
+                        " between matched places (default: {}).".format(
+                            DEFAULT_RADIUS), type=float,
+                        default=DEFAULT_RADIUS, dest="match_radius")
+
+    parser.add_argument('--metrics', help="Write metrics of the scraping "
+                        "(latencies, retries, downloaded bytes, parse time, "
+                        "queue depths) to this file.", default=None,
+                        dest="metrics_path")
+
+    parser.add_argument('--metrics-format', help="Format of the metrics "
+                        "file: 'jsonl' (a snapshot per line) or "
+                        "'prometheus' (textfile with the latest snapshot).",
+                        default="jsonl", choices=["jsonl", "prometheus"],
+                        dest="metrics_format")
+
+    parser.add_argument('--metrics-interval', help="Seconds between two "
+                        "snapshots of the metrics (default: {}).".format(
+                            DEFAULT_INTERVAL), type=float,
+                        default=DEFAULT_INTERVAL, dest="metrics_interval")
+
+    parser.add_argument('--batch', help="When source_path is a directory, "
+                        "load the places of the next files while the google "
+                        "searches of the others run, using one worker pool "
+                        "for all files.", action='store_true', dest="batch")
+
+    parser.add_argument('--batch-files', help="Number of files whose "
+                        "google searches run at the same time when using "
+                        "--batch (default: 2).", type=int, default=2,
+                        dest="batch_files")
+
+    parser.add_argument('--live', help="Poll the current popularity of the "
+                        "places with popular times in source_path (an output"
+                        " file of the scraper) and append the observations "
+                        "to target_path (line-delimited json).",
+                        action='store_true', dest="live")
+
+    parser.add_argument('--live-interval', help="Minutes between two rounds "
+                        "of polling (default: 15).", type=float, default=15,
+                        dest="live_interval")
+
+    parser.add_argument('--live-rounds', help="Number of rounds of polling "
+                        "(default: poll until interrupted).", type=int,
+                        default=None, dest="live_rounds")
+
+    parser.add_argument('--live-max-requests', help="Maximum number of "
+                        "places polled per round (the places that are open "
+                        "and change most often first, default: all open "
+                        "places).", type=int, default=None,
+                        dest="live_max_requests")
+
+    parser.add_argument('--utc-offset', help="Offset of the local time of "
+                        "the places in hours, used to determine which places"
+                        " are open when polling (default: local time of "
+                        "this machine).", type=float, default=None,
+                        dest="utc_offset")
+
+    parser.add_argument('--store', help="Append the current popularity of "
+                        "every searched (or polled) place to a time-series "
+                        "store in this directory.", default=None,
+                        dest="store_path")
+
+    parser.add_argument('--store-weekly', help="Also keep the popular times "
+                        "of the places in the store (--store).",
+                        action='store_true', dest="store_weekly")
+
+    parser.add_argument('--resume', help="Keep a journal of the completed "
+                        "google searches in <target>.journal and skip the "
+                        "places in it when the run is restarted.",
+                        action='store_true', dest="resume")
+
     return parser.parse_args(args)
 
 
+def journal_path(target):
+    """Return the path of the journal of completed google searches."""
+    return target + ".journal"
+
+
+def popularity_path(target):
+    """Return the path of the binary export of the popularity data."""
+    return target + ".popularity"
+
+
+def osm_params(params, source):
+    """Return the parameters for the OSM scraping."""
+    area = None
+    if not params.get('bounding_box_only', False):
+        area = load_area(source)
+
+    return dict(
+        area=area,
+        tag_filter_objects=params.get(
+            'tag_filter_objects', DEFAULT_TAG_FILTER_OBJECTS),
+        adaptive=params.get('adaptive', False),
+        max_elements=params.get('max_elements', 2000),
+        workers=params.get('osm_workers', 1),
+        metrics=params.get('metrics', NULL_METRICS),
+        tile_cache=params.get('tile_cache', None),
+        tile_zoom=params.get('tile_zoom', DEFAULT_TILE_ZOOM),
+        streaming=params.get('osm_streaming', False),
+        keep_tags=params.get('keep_tags', None),
+    )
+
+
+def google_params(params, target):
+    """Return the parameters for the google search scraping."""
+    group_searches = params.get('group_searches', None)
+    if group_searches is None:
+        # grouping reads all places, which would defeat streaming them
+        group_searches = not params.get('ndjson', False)
+
+    return dict(
+        num_processes=params.get('num_processes', 40),
+        proxies=params.get('proxies', None),
+        engine=params.get('engine', "pool"),
+        concurrency=params.get('concurrency', 200),
+        cache=params.get('cache', None),
+        journal=journal_path(target) if params.get('resume') else None,
+        group_searches=group_searches,
+        parse_processes=params.get('parse_processes', None),
+        compact=params.get('compact_popularity', False),
+        metrics=params.get('metrics', NULL_METRICS),
+        limiter=params.get('limiter', NO_LIMIT),
+        proxy_pool=params.get('proxy_pool', None),
+        pool=params.get('pool', None),
+        store=params.get('store', None),
+        prioritize=params.get('prioritize', False),
+        budget=params.get('budget', None),
+        search_url=params.get('search_url', SEARCH_URL),
+    )
+
+
+def live_params(params):
+    """Return the parameters for polling the current popularity."""
+    return dict(
+        interval=params.get('live_interval', 15) * 60,
+        max_requests=params.get('live_max_requests', None),
+        concurrency=params.get('concurrency', 200),
+        proxies=params.get('proxies', None),
+        metrics=params.get('metrics', NULL_METRICS),
+        limiter=params.get('limiter', NO_LIMIT),
+        proxy_pool=params.get('proxy_pool', None),
+        utc_offset=params.get('utc_offset', None),
+        search_url=params.get('search_url', SEARCH_URL),
+    )
+
+
+def remove_journal(target):
+    """Remove the journal after the results have been saved."""
+    if os.path.exists(journal_path(target)):
+        os.remove(journal_path(target))
+
+
 def scrape_file(source, target, **params):
     """Scrape area defined in source path and write places to target path."""
+    save_places(load_places(source, **params), target, **params)
+
+
+def load_places(source, **params):
+    """Get the places of the area defined in source path (OSM stage).
+
+    :return: dict with the places and the metadata (with ndjson: tuple of an
+        iterable of places and the metadata)
+    """
     info_stream = params.get('info_stream', sys.stdout)
     use_osm = params.get('use_osm', False)
-    use_google = params.get('use_google', False)
-    proxies = use_google = params.get('proxies', None)
-    google_processes = params.get('num_processes', 40)
+    ndjson = params.get('ndjson', False)
     tag_filter_objects = params.get(
         'tag_filter_objects', DEFAULT_TAG_FILTER_OBJECTS)
 
@@ -62,28 +418,277 @@ def scrape_file(source, target, **params):
         # get bounding box from source file
         bounding_box = load_bounding_box(source)
         info_stream.write("Downloading places from OSM Overpass API.\n")
-        data = dict(
-            places=scrape_osm(bounding_box),
+        places = scrape_osm(bounding_box, **osm_params(params, source))
+        meta = dict(
             osm_scraping_finished=current_time_str(),
             bounding_box=bounding_box,
             tag_filter_objects=tag_filter_objects,
         )
+    elif ndjson:
+        # lazily read places from line-delimited osm file
+        return iter_compact(iter_ndjson(source), params), load_meta(source)
     else:
         # get places from osm file
         with open(source, 'r') as f:
             data = json.load(f)
+        data['places'] = list(iter_compact(data['places'], params))
+        return data
 
-    if use_google:
+    if ndjson:
+        return places, meta
+    return dict(places=places, **meta)
+
+
+def iter_compact(places, params):
+    """Project the tags of places read from a file (see --keep-tags)."""
+    if params.get('keep_tags') is None:
+        return iter(places)
+    projection = tag_projection(params['keep_tags'])
+    return (compact_place(place, projection) for place in places)
+
+
+def save_places(data, target, **params):
+    """Run the google searches for places and write them to target path.
+
+    :param data: result of load_places
+    """
+    if params.get('ndjson', False):
+        return stream_places(*data, target, **params)
+
+    info_stream = params.get('info_stream', sys.stdout)
+
+    if params.get('use_google', False):
         info_stream.write("Running google searches.\n")
-        data['places'] = scrape_google(data['places'],
-                                       num_processes=google_processes,
-                                       proxies=proxies)
+        data['places'] = scrape_google(
+            data['places'], deduplicate=params.get('deduplicate', False),
+            **google_params(params, target))
         data['google_scraping_finished'] = current_time_str()
 
+        if params.get('match', False):
+            info_stream.write("Matching OSM and google places.\n")
+            data['places'] = match_places(
+                data['places'], radius=params.get('match_radius',
+                                                  DEFAULT_RADIUS))
+
+        if params.get('export_popularity', False):
+            info_stream.write("Exporting popularity data.\n")
+            write_popularity(data['places'], popularity_path(target))
+
     info_stream.write("Saving data at '{}'.\n".format(target))
     with open(target, 'w') as f:
         json.dump(data, f)
 
+    remove_journal(target)
+
+
+def stream_places(places, meta, target, **params):
+    """Run the google searches for places and stream them to target path.
+
+    Places are written to a line-delimited json file as soon as they are
+    processed, the metadata of the run is saved in a sidecar file.
+    """
+    info_stream = params.get('info_stream', sys.stdout)
+    use_google = params.get('use_google', False)
+
+    save_meta(meta, target)
+
+    if use_google:
+        info_stream.write("Running google searches.\n")
+        places = scrape_google_iter(places, **google_params(params, target))
+
+        if params.get('deduplicate', False):
+            # duplicates are streamed as update records and merged below
+            places = iter_deduplicated(places, updates=True)
+
+    info_stream.write("Streaming data to '{}'.\n".format(target))
+    meta['num_places'] = write_ndjson(places, target)
+
+    if use_google:
+        meta['google_scraping_finished'] = current_time_str()
+
+        if params.get('deduplicate', False):
+            info_stream.write("Merging duplicate places.\n")
+            meta['num_places'] = merge_file(target)
+
+        if params.get('match', False):
+            info_stream.write("Matching OSM and google places.\n")
+            match_file(target, params.get('match_radius', DEFAULT_RADIUS))
+
+        if params.get('export_popularity', False):
+            info_stream.write("Exporting popularity data.\n")
+            write_popularity(iter_ndjson(target), popularity_path(target))
+
+    save_meta(meta, target)
+    remove_journal(target)
+
+
+def scrape_files(jobs, num_files=2, **params):
+    """Scrape many files, sharing one worker pool between all of them.
+
+    The OSM stage runs in a background thread, one file after another, while
+    the google searches of up to num_files files run at the same time. The
+    process pool of the google searches (engine "pool") or of the parsing
+    (engine "pipeline") and the manager of the limiter and the proxy pool
+    are created once for all files. The outputs are the same as with
+    scrape_file.
+
+    :param jobs: list of tuples (source path, target path)
+    :param num_files: number of files whose google searches run at the same
+        time
+    """
+    params = dict(params)
+    pool, manager = None, None
+
+    if params.get('use_google', False):
+        engine = params.get('engine', "pool")
+        if engine == "pool":
+            pool = Pool(processes=params.get('num_processes', 40))
+            # the workers share the limiter and the proxy pool via a manager
+            # process
+            (params['limiter'], params['proxy_pool']), manager = share(
+                params.get('limiter', NO_LIMIT), params.get('proxy_pool'))
+        elif engine == "pipeline":
+            pool = Pool(processes=params.get('parse_processes'))
+        params['pool'] = pool
+
+    # the next file is loaded while the google searches of the others run
+    loaded = queue.Queue(maxsize=1)
+    in_flight = threading.Semaphore(num_files)
+    # set on the first error, stops the loading of further files
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                loaded.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def load_all():
+        try:
+            for source, target in jobs:
+                if stopped.is_set():
+                    return
+                put((target, load_places(source, **params)))
+        except BaseException as e:
+            put(e)
+        put(None)
+
+    def check_failed(futures):
+        # raises the error of the first failed file
+        for future in futures:
+            if future.done() and not future.cancelled():
+                future.result()
+
+    threading.Thread(target=load_all, daemon=True).start()
+
+    try:
+        with tqdm(total=len(jobs), unit="files") as bar, \
+                ThreadPoolExecutor(max_workers=num_files) as executor:
+
+            def done(_):
+                in_flight.release()
+                bar.update()
+
+            futures = list()
+            try:
+                while True:
+                    check_failed(futures)
+                    try:
+                        item = loaded.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    if item is None:
+                        break
+                    if isinstance(item, BaseException):
+                        raise item
+                    target, data = item
+                    while not in_flight.acquire(timeout=0.1):
+                        check_failed(futures)
+                    future = executor.submit(save_places, data, target,
+                                             **params)
+                    future.add_done_callback(done)
+                    futures.append(future)
+
+                wait(futures, return_when=FIRST_EXCEPTION)
+                check_failed(futures)
+            except BaseException:
+                # e.g. a dead proxy, the other files would fail the same way
+                stopped.set()
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if manager is not None:
+            manager.shutdown()
+
+
+def poll_file(source, target, **params):
+    """Poll the current popularity of the places of an output file.
+
+    The observations are appended to target path (one per line).
+    """
+    info_stream = params.get('info_stream', sys.stdout)
+
+    if params.get('ndjson', False):
+        places = iter_ndjson(source)
+    else:
+        with open(source, 'r') as f:
+            places = json.load(f)['places']
+
+    poller = LivePoller(places, **live_params(params))
+    info_stream.write("Polling the current popularity of {} places.\n"
+                      .format(len(poller.places)))
+
+    store = params.get('store', None)
+
+    with open(target, 'a') as f:
+        def write(observation):
+            f.write(json.dumps(observation))
+            f.write("\n")
+            f.flush()
+
+            if store is not None and observation['place_id'] is not None:
+                store.append(observation['place_id'], observation['time'],
+                             observation['current_popularity'])
+
+        poller.run(write, rounds=params.get('live_rounds', None))
+
+
+def merge_file(path):
+    """Merge the update records of duplicates into the places of a file.
+
+    Like match_file, the file is read twice and only the OSM places of the
+    duplicates are kept in memory.
+
+    :return: number of places
+    """
+    duplicates = collect_updates(iter_ndjson(path))
+
+    tmp_path = path + ".tmp"
+    num_places = write_ndjson(
+        merge_updates(iter_ndjson(path), duplicates), tmp_path)
+    os.replace(tmp_path, path)
+    return num_places
+
+
+def match_file(path, radius):
+    """Add match information to the places of a line-delimited json file.
+
+    The file is read twice (once for building the index of the google
+    places, once for matching), so the places are not kept in memory.
+    """
+    index = build_index(iter_ndjson(path), radius=radius)
+
+    tmp_path = path + ".tmp"
+    write_ndjson((match_record(record, index)
+                  for record in iter_ndjson(path)), tmp_path)
+    os.replace(tmp_path, path)
+
 
 def parse_proxy(args):
     """Convert string to proxy host and port."""
@@ -110,6 +715,76 @@ def params_from_args(args):
         params['use_osm'], params['use_google'] = args.osm, args.google
 
     params['num_processes'] = args.num_processes
+    params['engine'] = args.engine
+    params['concurrency'] = args.concurrency
+    params['search_url'] = args.search_url
+    params['parse_processes'] = args.parse_processes
+    params['ndjson'] = args.ndjson
+    params['resume'] = args.resume
+    params['group_searches'] = args.group_searches
+    params['prioritize'] = args.prioritize
+    params['budget'] = args.budget
+    params['deduplicate'] = args.deduplicate
+    params['compact_popularity'] = args.compact_popularity
+    params['export_popularity'] = args.export_popularity
+    params['match'] = args.match
+    params['match_radius'] = args.match_radius
+    params['adaptive'] = args.adaptive
+    params['max_elements'] = args.max_elements
+    params['osm_workers'] = args.osm_workers
+    params['bounding_box_only'] = args.bounding_box_only
+    params['tile_zoom'] = args.tile_zoom
+    params['osm_streaming'] = args.osm_streaming
+    params['keep_tags'] = args.keep_tags
+    params['live_interval'] = args.live_interval
+    params['live_rounds'] = args.live_rounds
+    params['live_max_requests'] = args.live_max_requests
+    params['utc_offset'] = args.utc_offset
+
+    if args.store_path is not None:
+        params['store'] = ObservationStore(args.store_path,
+                                           weekly=args.store_weekly)
+
+    if args.osm_cache_path is not None:
+        params['tile_cache'] = TileCache(
+            args.osm_cache_path, ttl=args.osm_cache_ttl * 24 * 60 * 60)
+
+    if args.cache_path is not None:
+        max_size = args.cache_max_size
+        if max_size is not None:
+            max_size = int(max_size * 1024 * 1024)
+        params['cache'] = ResponseCache(
+            args.cache_path,
+            ttl=args.cache_ttl * 24 * 60 * 60,
+            max_size=max_size,
+            offline=args.offline,
+        )
+    elif args.offline:
+        print ("The --offline option requires a cache (--cache).")
+        quit()
+
+    if args.adaptive_concurrency or args.max_rate is not None:
+        if args.engine == "pool":
+            max_limit = args.num_processes
+        else:
+            max_limit = args.concurrency
+        if args.adaptive_concurrency:
+            limiter_params = dict(min_limit=args.min_concurrency,
+                                  max_latency=args.max_latency)
+        else:
+            # only limit the rate
+            limiter_params = dict(min_limit=max_limit,
+                                  initial_limit=max_limit)
+        params['limiter'] = AdaptiveLimiter(
+            max_limit=max_limit, rate=args.max_rate, **limiter_params)
+
+    if args.metrics_path is not None:
+        if args.metrics_format == "prometheus":
+            sink = PrometheusTextfileSink(args.metrics_path)
+        else:
+            sink = JsonLinesSink(args.metrics_path)
+        params['metrics'] = Metrics(sinks=[sink],
+                                    interval=args.metrics_interval)
 
     # If a tag filter file has been specified, load file
     if args.tag_filter_path is not None:
@@ -141,44 +816,83 @@ def main():
         params["proxies"] = dict(http=s5_proxy, https=s5_proxy)
         # init_proxy(params['proxy_host'], params['proxy_port'])
 
-    # check if conneciton is available
-    proxy_ip = get_external_ip(proxies=params["proxies"])
-    if not proxy_ip:
-        print ("Connection via proxy could not be established.")
-        quit()
-    print("Connection tested. Using external ip {} for google search.".format(proxy_ip))
+    if args.offline:
+        print("Offline mode. Using cached responses for google search.")
+    elif args.proxy_file is not None:
+        # check all proxies of the pool and only keep the working ones
+        urls = load_proxies(args.proxy_file)
+        working = check_proxies(urls)
+        if not working:
+            print ("Connection via the proxies could not be established.")
+            quit()
+        print("Connection tested. Using {} of {} proxies for google "
+              "search.".format(len(working), len(urls)))
+        params['proxy_pool'] = ProxyPool(
+            [url for url in urls if url in working],
+            max_concurrency=args.proxy_concurrency, rate=args.proxy_rate,
+            adaptive=args.adaptive_concurrency,
+            max_latency=args.max_latency)
+    else:
+        # check if conneciton is available
+        proxy_ip = get_external_ip(proxies=params.get("proxies"))
+        if not proxy_ip:
+            print ("Connection via proxy could not be established.")
+            quit()
+        print("Connection tested. Using external ip {} for google search.".format(proxy_ip))
 
     # check if input is directory or file
     if not os.path.exists(args.source_path):
         print ("Source path '{}' does not exist".format(args.source_path))
         return False
 
-    if os.path.isdir(args.source_path):
-        if not os.path.isdir(args.target_path):
-            print ("If source path is a directory, target path must be a"
-                   "directory as well.")
-            quit()
+    if 'store' in params:
+        # seal the segment of the store when the run ends (or is
+        # interrupted)
+        atexit.register(params['store'].close)
 
-        # recursively go through all files in dir
-        paths = list()
-        for dirname, _, filenames in os.walk(args.source_path):
-            for filename in filenames:
-                paths.append(os.path.join(dirname, filename))
-
-        # show a progress bar displaying the number of file already processed
-        with tqdm(paths, unit="files") as bar:
-            # process all files in the directory
-            for path in bar:
-                # determine the target path
+    try:
+        if args.live:
+            poll_file(args.source_path, args.target_path, **params)
+        elif os.path.isdir(args.source_path):
+            if not os.path.isdir(args.target_path):
+                print ("If source path is a directory, target path must be a"
+                       "directory as well.")
+                quit()
+
+            # recursively go through all files in dir
+            paths = list()
+            for dirname, _, filenames in os.walk(args.source_path):
+                for filename in filenames:
+                    # skip the metadata of line-delimited json files
+                    if filename.endswith(meta_path("")):
+                        continue
+                    if filename.endswith(popularity_path("")):
+                        continue
+                    paths.append(os.path.join(dirname, filename))
+
+            # determine the target paths
+            jobs = list()
+            for path in paths:
                 basename = os.path.basename(path)
-                name = os.path.splitext(basename)[0] + '.json'
-                target = os.path.join(args.target_path, name)
-
-                # process the file
-                scrape_file(path, target, **params)
-    else:
-        path = args.source_path
-        target = args.target_path
-        scrape_file(path, target, **params)
+                extension = '.ndjson' if args.ndjson else '.json'
+                name = os.path.splitext(basename)[0] + extension
+                jobs.append((path, os.path.join(args.target_path, name)))
+
+            if args.batch:
+                scrape_files(jobs, num_files=args.batch_files, **params)
+            else:
+                # show a progress bar displaying the number of file already
+                # processed
+                with tqdm(jobs, unit="files") as bar:
+                    # process all files in the directory
+                    for path, target in bar:
+                        scrape_file(path, target, **params)
+        else:
+            path = args.source_path
+            target = args.target_path
+            scrape_file(path, target, **params)
+    except SearchFailedError:
+        print("Check proxy!")
+        quit()
 
     print("Done.")
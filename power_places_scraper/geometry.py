@@ -0,0 +1,185 @@
+"""Polygon areas for restricting the scraped places and map tiles."""
+
+import math
+
+
+def polygons_from_geojson(geo_json):
+    """Return the polygons of a geojson object.
+
+    Supports feature collections, features, polygons and multipolygons.
+
+    :return: list of polygons, each polygon is a list of rings
+    """
+    kind = geo_json.get("type")
+    if kind == "FeatureCollection":
+        return [polygon
+                for feature in geo_json["features"]
+                for polygon in polygons_from_geojson(feature)]
+    elif kind == "Feature":
+        return polygons_from_geojson(geo_json["geometry"])
+    elif kind == "Polygon":
+        return [geo_json["coordinates"]]
+    elif kind == "MultiPolygon":
+        return list(geo_json["coordinates"])
+    else:
+        raise ValueError("Unsupported geometry type '{}'.".format(kind))
+
+
+def segments_intersect(a, b, c, d):
+    """Check whether the segments a-b and c-d intersect."""
+    def orientation(p, q, r):
+        value = (q[1] - p[1]) * (r[0] - q[0]) - (q[0] - p[0]) * (r[1] - q[1])
+        return (value > 0) - (value < 0)
+
+    def on_segment(p, q, r):
+        return (min(p[0], r[0]) <= q[0] <= max(p[0], r[0])
+                and min(p[1], r[1]) <= q[1] <= max(p[1], r[1]))
+
+    o1, o2 = orientation(a, b, c), orientation(a, b, d)
+    o3, o4 = orientation(c, d, a), orientation(c, d, b)
+
+    if o1 != o2 and o3 != o4:
+        return True
+
+    # collinear cases
+    return ((o1 == 0 and on_segment(a, c, b))
+            or (o2 == 0 and on_segment(a, d, b))
+            or (o3 == 0 and on_segment(c, a, d))
+            or (o4 == 0 and on_segment(c, b, d)))
+
+
+class Area:
+    """Area consisting of one or more polygons (with holes).
+
+    Positions of the polygons are given in geojson order (lng, lat), the
+    methods of the area use (lat, lng) like the rest of the scraper.
+    """
+
+    def __init__(self, polygons):
+        """Initialize the area.
+
+        :param polygons: list of polygons, each polygon is a list of rings
+            (the first ring is the outline, the others are holes) and each
+            ring is a list of (lng, lat) positions
+        """
+        self.polygons = list()
+
+        for rings in polygons:
+            # edges as ((lat, lng), (lat, lng)) tuples, holes are handled by
+            # the even-odd rule of the point in polygon test
+            edges = list()
+            for ring in rings:
+                points = [(float(p[1]), float(p[0])) for p in ring]
+                edges.extend(zip(points, points[1:] + points[:1]))
+
+            if not edges:
+                continue
+
+            lats = [p[0] for p, _ in edges]
+            lngs = [p[1] for p, _ in edges]
+            box = ((min(lats), min(lngs)), (max(lats), max(lngs)))
+
+            self.polygons.append((box, edges))
+
+    @classmethod
+    def from_geojson(cls, geo_json):
+        """Create an area from a geojson object."""
+        return cls(polygons_from_geojson(geo_json))
+
+    @property
+    def bounding_box(self):
+        """Return the bounding box ((south, west), (north, east))."""
+        boxes = [box for box, _ in self.polygons]
+        return (
+            (min(b[0][0] for b in boxes), min(b[0][1] for b in boxes)),
+            (max(b[1][0] for b in boxes), max(b[1][1] for b in boxes)),
+        )
+
+    def contains(self, lat, lng):
+        """Check whether a position lies within the area."""
+        for ((south, west), (north, east)), edges in self.polygons:
+            # cheap check of the bounding box first
+            if not (south <= lat <= north and west <= lng <= east):
+                continue
+
+            # cast a ray along the longitude and count the crossed edges
+            inside = False
+            for (lat1, lng1), (lat2, lng2) in edges:
+                if (lat1 > lat) != (lat2 > lat):
+                    ratio = (lat - lat1) / (lat2 - lat1)
+                    if lng < lng1 + ratio * (lng2 - lng1):
+                        inside = not inside
+
+            if inside:
+                return True
+
+        return False
+
+    def intersects(self, bounding_box):
+        """Check whether a bounding box intersects the area."""
+        (south, west), (north, east) = bounding_box
+
+        corners = [(south, west), (south, east), (north, east), (north, west)]
+        sides = list(zip(corners, corners[1:] + corners[:1]))
+
+        for ((p_south, p_west), (p_north, p_east)), edges in self.polygons:
+            if (p_south > north or p_north < south
+                    or p_west > east or p_east < west):
+                continue
+
+            # a vertex of the polygon lies in the box
+            for (lat, lng), _ in edges:
+                if south <= lat <= north and west <= lng <= east:
+                    return True
+
+            # an edge of the polygon crosses a side of the box
+            for a, b in edges:
+                for c, d in sides:
+                    if segments_intersect(a, b, c, d):
+                        return True
+
+        # the box may still lie completely within a polygon
+        return self.contains(south, west)
+
+
+def box_contains(bounding_box, lat, lng):
+    """Check whether a position lies within a bounding box."""
+    (south, west), (north, east) = bounding_box
+    return south <= lat <= north and west <= lng <= east
+
+
+def tile_of(lat, lng, zoom):
+    """Return the (slippy map) tile (zoom, x, y) containing a position."""
+    n = 2 ** zoom
+    lat = max(-85.0511, min(85.0511, lat))
+    x = int((lng + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return zoom, min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounding_box(tile):
+    """Return the bounding box ((south, west), (north, east)) of a tile."""
+    zoom, x, y = tile
+    n = 2 ** zoom
+
+    def lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return (lat(y + 1), x / n * 360 - 180), (lat(y), (x + 1) / n * 360 - 180)
+
+
+def tiles_in(bounding_box, zoom):
+    """Return the tiles of a zoom level that cover a bounding box."""
+    (south, west), (north, east) = bounding_box
+    _, min_x, min_y = tile_of(north, west, zoom)
+    _, max_x, max_y = tile_of(south, east, zoom)
+    return [(zoom, x, y)
+            for x in range(min_x, max_x + 1)
+            for y in range(min_y, max_y + 1)]
+
+
+def child_tiles(tile):
+    """Return the four tiles of the next zoom level within a tile."""
+    zoom, x, y = tile
+    return [(zoom + 1, 2 * x + dx, 2 * y + dy)
+            for dy in (0, 1) for dx in (0, 1)]
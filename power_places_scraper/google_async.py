@@ -0,0 +1,309 @@
+"""Asyncio engine for getting information from the google search.
+
+All searches run as coroutines in a single process and share one
+connection-pooled http session (one per socks proxy when using a proxy pool).
+This requires aiohttp (and aiohttp-socks when using a socks proxy).
+"""
+
+import asyncio
+import functools
+import inspect
+import queue
+import threading
+import time
+
+from power_places_scraper.google_scraper import (
+    USER_AGENT, SEARCH_URL, REQUEST_TIMEOUT, get_search_string,
+    get_search_params, parse_fetched, retry_cause, record_limit,
+    release_request)
+from power_places_scraper.metrics import NULL_METRICS
+from power_places_scraper.limiter import NO_LIMIT
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+# marks the end of the results in the queue between event loop and consumer
+_DONE = object()
+
+
+def get_proxy_url(proxies):
+    """Return the proxy url from a requests style proxy dict."""
+    if not proxies:
+        return None
+    return proxies.get('https') or proxies.get('http')
+
+
+def create_session(concurrency, proxies=None):
+    """Create a http session with a connection pool of the given size."""
+    if aiohttp is None:
+        raise ImportError("The asyncio engine requires aiohttp "
+                          "(pip install aiohttp).")
+
+    proxy_url = get_proxy_url(proxies)
+
+    if proxy_url and proxy_url.startswith("socks"):
+        try:
+            from aiohttp_socks import ProxyConnector
+        except ImportError:
+            raise ImportError("Using a socks proxy with the asyncio engine "
+                              "requires aiohttp-socks "
+                              "(pip install aiohttp-socks).")
+        connector = ProxyConnector.from_url(proxy_url, limit=concurrency)
+    else:
+        connector = aiohttp.TCPConnector(limit=concurrency)
+
+    return aiohttp.ClientSession(connector=connector, headers=USER_AGENT)
+
+
+def is_socks(proxy_url):
+    """Check whether a proxy url is a socks proxy."""
+    return bool(proxy_url) and proxy_url.startswith("socks")
+
+
+class Sessions:
+    """Http sessions of the searches.
+
+    Socks proxies are set on the connector of a session, so every socks
+    proxy gets its own session. Http proxies are passed with each request.
+    """
+
+    def __init__(self, concurrency, proxies=None):
+        """Initialize without any sessions (they are created lazily)."""
+        self.concurrency = concurrency
+        self.proxies = proxies
+        self.sessions = dict()
+
+    def get(self, proxy_url=None):
+        """Return the session and the http proxy of a request.
+
+        :param proxy_url: url of a proxy of a proxy pool (None: use the
+            default proxies)
+        :return: tuple (session, http proxy url or None)
+        """
+        if proxy_url is None:
+            key, proxies = None, self.proxies
+            proxy_url = get_proxy_url(self.proxies)
+        elif is_socks(proxy_url):
+            key, proxies = proxy_url, dict(http=proxy_url, https=proxy_url)
+        else:
+            key, proxies = "", None
+
+        if key not in self.sessions:
+            self.sessions[key] = create_session(self.concurrency,
+                                                proxies=proxies)
+
+        return self.sessions[key], None if is_socks(proxy_url) else proxy_url
+
+    async def close(self):
+        """Close all sessions."""
+        for session in self.sessions.values():
+            await session.close()
+
+
+async def fetch_search_response(sessions, search_string, cache=None,
+                                search_url=SEARCH_URL, metrics=NULL_METRICS,
+                                limiter=NO_LIMIT, proxy_pool=None,
+                                timeout=REQUEST_TIMEOUT):
+    """Request the google search for a search string and return the body.
+
+    :param timeout: seconds until a try without a response is given up
+        (see google_scraper.fetch_search_response)
+    :return: the response text or None if the request failed repeatedly (or
+        the search is not cached when the cache is offline)
+    """
+    params = get_search_params(search_string)
+    loop = asyncio.get_running_loop()
+
+    if cache is not None:
+        # sqlite blocks, so the cache is accessed in the default executor
+        text = await loop.run_in_executor(None, cache.get, params)
+        metrics.inc("google_cache_lookups_total",
+                    result="miss" if text is None else "hit")
+        if text is not None or cache.offline:
+            return text
+
+    if proxy_pool is not None:
+        timeout = min(timeout, proxy_pool.request_timeout())
+
+    sleep_time = 1
+
+    while True:
+        await limiter.acquire_async()
+        proxy_url = None
+        if proxy_pool is not None:
+            proxy_url = await proxy_pool.acquire_async()
+        start = time.perf_counter()
+        cause = "connection"
+        try:
+            if proxy_pool is not None and proxy_url is None:
+                # no proxy became available in time (e.g. all of them are
+                # quarantined), counts as a failed try
+                cause = "no_proxy"
+            else:
+                session, proxy = sessions.get(proxy_url)
+                async with session.get(
+                        search_url, params=params, proxy=proxy,
+                        timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                    body = await resp.read()
+                    text = await resp.text()
+                    ok = resp.ok
+                    status = resp.status
+
+                cause = retry_cause(status, text)
+                metrics.observe("google_request_seconds",
+                                time.perf_counter() - start, status=status)
+                metrics.inc("google_downloaded_bytes_total", len(body))
+        except asyncio.TimeoutError:
+            cause = "timeout"
+        except (aiohttp.ClientError, IOError):
+            pass
+        finally:
+            release_request(cause, time.perf_counter() - start, limiter,
+                            proxy_pool, proxy_url, metrics)
+
+        record_limit(metrics, limiter)
+        if cause is None:
+            break
+
+        metrics.inc("google_retries_total", cause=cause)
+
+        if sleep_time > 100:
+            metrics.inc("google_failed_searches_total")
+            return None
+        else:
+            metrics.inc("google_backoff_seconds_total", sleep_time)
+            await asyncio.sleep(sleep_time)
+            sleep_time <<= 2
+
+    if cache is not None and ok:
+        await loop.run_in_executor(None, cache.put, params, text)
+
+    return text
+
+
+async def get_google_info(sessions, place, cache=None,
+                          search_url=SEARCH_URL, compact=False,
+                          metrics=NULL_METRICS, limiter=NO_LIMIT,
+                          proxy_pool=None):
+    """Request information for a place (see google_scraper.get_google_info).
+
+    :param sessions: the shared http Sessions
+    :param place: place, scraped from osm
+    :param cache: optional ResponseCache for the search responses
+    :param search_url: url of the search
+    :param compact: use the compact popularity representation
+    :param metrics: Metrics of the request and the parsing
+    :param limiter: limiter of the concurrency and rate of the requests
+    :param proxy_pool: optional ProxyPool used instead of the default proxies
+    :return:
+    """
+    search_string = get_search_string(place)
+
+    text = await fetch_search_response(sessions, search_string, cache=cache,
+                                       search_url=search_url,
+                                       metrics=metrics, limiter=limiter,
+                                       proxy_pool=proxy_pool)
+
+    # parsing is cpu bound and would stall the other searches
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(
+            parse_fetched,
+            (place, search_string, text, cache is not None and cache.offline),
+            compact=compact, metrics=metrics, search_url=search_url))
+
+
+async def search_places(places, callback, concurrency=200, proxies=None,
+                        cache=None, search_url=SEARCH_URL, compact=False,
+                        metrics=NULL_METRICS, limiter=NO_LIMIT,
+                        proxy_pool=None, cancelled=None):
+    """Run searches for places and call callback for each result.
+
+    At most concurrency searches are in flight at the same time. Once the
+    optional threading.Event cancelled is set, no new searches are started.
+    If the result of callback is awaitable, it is awaited before the worker
+    starts its next search.
+    """
+    places = iter(places)
+
+    sessions = Sessions(concurrency, proxies=proxies)
+
+    async def worker():
+        # all workers share the same iterator, so each place is only
+        # searched once
+        for place in places:
+            if cancelled is not None and cancelled.is_set():
+                return
+            called = callback(await get_google_info(
+                sessions, place, cache=cache, search_url=search_url,
+                compact=compact, metrics=metrics, limiter=limiter,
+                proxy_pool=proxy_pool))
+            if inspect.isawaitable(called):
+                await called
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        await sessions.close()
+
+
+def iter_google_info(places, concurrency=200, proxies=None, cache=None,
+                     search_url=SEARCH_URL, compact=False,
+                     metrics=NULL_METRICS, limiter=NO_LIMIT, proxy_pool=None):
+    """Yield search results for places in the order they are completed.
+
+    The event loop runs in a background thread, so the results can be
+    consumed like those of Pool.imap_unordered. At most concurrency results
+    wait for the consumer, the searches are paused while they do. Closing
+    the generator stops the searches.
+    """
+    results = queue.Queue(maxsize=concurrency)
+    cancelled = threading.Event()
+
+    def put(item):
+        # gives up once the consumer is gone
+        while not cancelled.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    async def put_async(item):
+        # the queue blocks while it is full, not the event loop
+        await asyncio.get_running_loop().run_in_executor(None, put, item)
+
+    def target():
+        try:
+            asyncio.run(search_places(places, put_async,
+                                      concurrency=concurrency,
+                                      proxies=proxies, cache=cache,
+                                      search_url=search_url,
+                                      compact=compact, metrics=metrics,
+                                      limiter=limiter,
+                                      proxy_pool=proxy_pool,
+                                      cancelled=cancelled))
+        except BaseException as e:
+            put(e)
+        put(_DONE)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            result = results.get()
+            metrics.set("google_queue_depth", results.qsize(),
+                        queue="results")
+            if result is _DONE:
+                break
+            if isinstance(result, BaseException):
+                raise result
+            yield result
+    finally:
+        # the searches in flight are completed, no new ones are started
+        cancelled.set()
+
+    thread.join()
@@ -7,35 +7,48 @@ https://github.com/m-wrzr/populartimes
 
 import requests
 import functools
+import itertools
 
 import re
-import calendar
 
 import json
+import time
 from time import sleep
 
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
 from tqdm import tqdm
 
+from power_places_scraper.places import SEARCH_TAGS, FULL_ADDRESS_TAG
+from power_places_scraper.popularity import parse_popularity, to_day_dicts
+from power_places_scraper.metrics import (
+    NULL_METRICS, measure_call, iter_merged)
+from power_places_scraper.limiter import NO_LIMIT, share
+from power_places_scraper.proxies import requests_proxies, proxy_label
+from power_places_scraper.priority import PriorityScheduler
+
+# marks the end of the fetched bodies in the queue of the pipeline
+_DONE = object()
+
 # user agent for populartimes request
 USER_AGENT = {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_1) "
                             "AppleWebKit/537.36 (KHTML, like Gecko) "
                             "Chrome/54.0.2840.98 Safari/537.36"}
 
 
+class SearchFailedError(RuntimeError):
+    """A google search failed (e.g. because the proxy does not work)."""
+
+
 def get_search_string(place):
     """Build a search string for an osm place."""
     tags = place['tags']
-    if 'addr:full' in tags:
-        return "{} {}".format(tags['name'], tags['addr:full'])
+    if FULL_ADDRESS_TAG in tags:
+        return "{} {}".format(tags['name'], tags[FULL_ADDRESS_TAG])
     else:
-        return " ".join([
-            tags[key] for key in [
-                'name', 'addr:street', 'addr:housenumber', 'addr:postcode',
-                'addr:city', 'addr:province'
-            ]
-            if key in tags
-        ])
+        return " ".join([tags[key] for key in SEARCH_TAGS if key in tags])
 
 
 def index_get(array, *argv):
@@ -64,99 +77,194 @@ def get_popularity_for_day(popularity):
     :param popularity:
     :return:
     """
-    # Initialize empty matrix with 0s
-    pop_json = [[0 for _ in range(24)] for _ in range(7)]
-    wait_json = [[0 for _ in range(24)] for _ in range(7)]
+    pop, wait = parse_popularity(popularity)
 
-    for day in popularity:
+    # waiting time only if applicable
+    ret_wait = to_day_dicts(wait) if any(wait) else []
 
-        day_no, pop_times = day[:2]
+    # {"name" : "monday", "data": [...]} for each weekday as list
+    return to_day_dicts(pop), ret_wait
 
-        if pop_times:
-            for hour_info in pop_times:
 
-                hour = hour_info[0]
-                pop_json[day_no - 1][hour] = hour_info[1]
+SEARCH_URL = "https://www.google.de/search"
 
-                # check if the waiting string is available and convert to mins
-                if len(hour_info) > 5:
-                    wait_digits = re.findall(r'\d+', hour_info[3])
+# seconds until a search request without a response is given up
+REQUEST_TIMEOUT = 30
 
-                    if len(wait_digits) == 0:
-                        wait_json[day_no - 1][hour] = 0
-                    elif "min" in hour_info[3]:
-                        wait_json[day_no - 1][hour] = int(wait_digits[0])
-                    elif "hour" in hour_info[3]:
-                        wait_json[day_no - 1][hour] = int(wait_digits[0]) * 60
-                    else:
-                        wait_json[day_no - 1][hour] = int(wait_digits[0]) * 60 + int(wait_digits[1])
+SEARCH_PB = (
+    "!4m12!1m3!1d4005.9771522653964!2d-122.42072974863942!3d37.8077459796541!2m3!1f0!2f0!3f0!3m2!1i1125!2i976"
+    "!4f13.1!7i20!10b1!12m6!2m3!5m1!6e2!20e3!10b1!16b1!19m3!2m2!1i392!2i106!20m61!2m2!1i203!2i100!3m2!2i4!5b1"
+    "!6m6!1m2!1i86!2i86!1m2!1i408!2i200!7m46!1m3!1e1!2b0!3e3!1m3!1e2!2b1!3e2!1m3!1e2!2b0!3e3!1m3!1e3!2b0!3e3!"
+    "1m3!1e4!2b0!3e3!1m3!1e8!2b0!3e3!1m3!1e3!2b1!3e2!1m3!1e9!2b1!3e2!1m3!1e10!2b0!3e3!1m3!1e10!2b1!3e2!1m3!1e"
+    "10!2b0!3e4!2b1!4b1!9b0!22m6!1sa9fVWea_MsX8adX8j8AE%3A1!2zMWk6Mix0OjExODg3LGU6MSxwOmE5ZlZXZWFfTXNYOGFkWDh"
+    "qOEFFOjE!7e81!12e3!17sa9fVWea_MsX8adX8j8AE%3A564!18e15!24m15!2b1!5m4!2b1!3b1!5b1!6b1!10m1!8e3!17b1!24b1!"
+    "25b1!26b1!30m1!2b1!36b1!26m3!2m2!1i80!2i92!30m28!1m6!1m2!1i0!2i0!2m2!1i458!2i976!1m6!1m2!1i1075!2i0!2m2!"
+    "1i1125!2i976!1m6!1m2!1i0!2i0!2m2!1i1125!2i20!1m6!1m2!1i0!2i956!2m2!1i1125!2i976!37m1!1e81!42b1!47m0!49m1"
+    "!3b1"
+)
 
-                # day wrap
-                if hour_info[0] == 23:
-                    day_no = day_no % 7 + 1
 
-    ret_popularity = [
-        {
-            "name": list(calendar.day_name)[d],
-            "data": pop_json[d]
-        } for d in range(7)
-    ]
+def get_search_params(search_string):
+    """Return the query parameters for a google search."""
+    return {
+        "tbm": "map",
+        "tch": 1,
+        "hl": "en",
+        "q": search_string,
+        "pb": SEARCH_PB,
+    }
 
-    # waiting time only if applicable
-    ret_wait = [
-        {
-            "name": list(calendar.day_name)[d],
-            "data": wait_json[d]
-        } for d in range(7)
-    ] if any(any(day) for day in wait_json) else []
 
-    # {"name" : "monday", "data": [...]} for each weekday as list
-    return ret_popularity, ret_wait
+# start of the (json string) payload of a search response
+PAYLOAD_START = re.compile(r'"d"\s*:\s*"(.)')
 
 
-def get_google_info(place, proxies=None):
-    """Request information for a place and parse current popularity.
+def is_throttled_body(text):
+    """Check whether a response body shows that google throttles requests.
 
-    :param place: place, scraped from osm
-    :return:
+    Throttled searches are answered with a captcha page (html instead of
+    json) or an empty payload.
     """
+    if text.lstrip().startswith("<"):
+        return True
+    payload = PAYLOAD_START.search(text)
+    return payload is None or payload.group(1) == '"'
 
-    search_string = get_search_string(place)
 
-    params = {
-        "tbm": "map",
-        "tch": 1,
-        "hl": "en",
-        "q": search_string,
-        "pb": "!4m12!1m3!1d4005.9771522653964!2d-122.42072974863942!3d37.8077459796541!2m3!1f0!2f0!3f0!3m2!1i1125!2i976"
-              "!4f13.1!7i20!10b1!12m6!2m3!5m1!6e2!20e3!10b1!16b1!19m3!2m2!1i392!2i106!20m61!2m2!1i203!2i100!3m2!2i4!5b1"
-              "!6m6!1m2!1i86!2i86!1m2!1i408!2i200!7m46!1m3!1e1!2b0!3e3!1m3!1e2!2b1!3e2!1m3!1e2!2b0!3e3!1m3!1e3!2b0!3e3!"
-              "1m3!1e4!2b0!3e3!1m3!1e8!2b0!3e3!1m3!1e3!2b1!3e2!1m3!1e9!2b1!3e2!1m3!1e10!2b0!3e3!1m3!1e10!2b1!3e2!1m3!1e"
-              "10!2b0!3e4!2b1!4b1!9b0!22m6!1sa9fVWea_MsX8adX8j8AE%3A1!2zMWk6Mix0OjExODg3LGU6MSxwOmE5ZlZXZWFfTXNYOGFkWDh"
-              "qOEFFOjE!7e81!12e3!17sa9fVWea_MsX8adX8j8AE%3A564!18e15!24m15!2b1!5m4!2b1!3b1!5b1!6b1!10m1!8e3!17b1!24b1!"
-              "25b1!26b1!30m1!2b1!36b1!26m3!2m2!1i80!2i92!30m28!1m6!1m2!1i0!2i0!2m2!1i458!2i976!1m6!1m2!1i1075!2i0!2m2!"
-              "1i1125!2i976!1m6!1m2!1i0!2i0!2m2!1i1125!2i20!1m6!1m2!1i0!2i956!2m2!1i1125!2i976!37m1!1e81!42b1!47m0!49m1"
-              "!3b1"
-    }
+def retry_cause(status, text=None):
+    """Return why a request should be retried after a response.
+
+    Throttled requests (429, captcha pages, empty payloads) and server errors
+    are retried.
+
+    :param text: the response body (only checked for successful responses)
+    :return: "throttled", "server_error" or None if it is not retried
+    """
+    if status == 429:
+        return "throttled"
+    if status >= 500:
+        return "server_error"
+    if text is not None and 200 <= status < 300 and is_throttled_body(text):
+        return "throttled"
+    return None
+
+
+def request_outcome(cause):
+    """Return the outcome of a request for the limiter."""
+    if cause is None:
+        return "ok"
+    if cause == "throttled":
+        return "throttled"
+    return "error"
+
+
+def fetch_search_response(search_string, proxies=None, cache=None,
+                          search_url=SEARCH_URL, metrics=NULL_METRICS,
+                          limiter=NO_LIMIT, proxy_pool=None,
+                          timeout=REQUEST_TIMEOUT):
+    """Request the google search for a search string and return the body.
+
+    :param cache: optional ResponseCache, which is asked before sending the
+        request and stores successful responses
+    :param search_url: url of the search (e.g. of a local test server)
+    :param metrics: Metrics for the requests, retries and downloaded bytes
+    :param limiter: limiter of the concurrency and rate of the requests
+        (see limiter module), every try is started and finished with it
+    :param proxy_pool: optional ProxyPool, every try uses the proxy it
+        chooses instead of proxies
+    :param timeout: seconds until a try without a response is given up
+        (at most the request timeout of the proxy pool), it counts as an
+        error
+    :return: the response text or None if the request failed repeatedly (or
+        the search is not cached when the cache is offline)
+    """
+    params = get_search_params(search_string)
 
-    search_url = "https://www.google.de/search"
+    if cache is not None:
+        text = cache.get(params)
+        metrics.inc("google_cache_lookups_total",
+                    result="miss" if text is None else "hit")
+        if text is not None or cache.offline:
+            return text
+
+    if proxy_pool is not None:
+        timeout = min(timeout, proxy_pool.request_timeout())
 
     sleep_time = 1
 
     while True:
+        limiter.acquire()
+        proxy_url = None
+        if proxy_pool is not None:
+            proxy_url = proxy_pool.acquire()
+        start = time.perf_counter()
+        cause = "connection"
         try:
-            resp = requests.get(search_url, params=params,
-                proxies=proxies, headers=USER_AGENT)
+            if proxy_pool is not None and proxy_url is None:
+                # no proxy became available in time (e.g. all of them are
+                # quarantined), counts as a failed try
+                cause = "no_proxy"
+            else:
+                resp = requests.get(
+                    search_url, params=params,
+                    proxies=(requests_proxies(proxy_url) if proxy_url
+                             else proxies),
+                    headers=USER_AGENT, timeout=timeout)
+
+                cause = retry_cause(resp.status_code, resp.text)
+                metrics.observe("google_request_seconds",
+                                time.perf_counter() - start,
+                                status=resp.status_code)
+                metrics.inc("google_downloaded_bytes_total",
+                            len(resp.content))
+        except requests.Timeout:
+            cause = "timeout"
+        except IOError:
+            pass
+        finally:
+            release_request(cause, time.perf_counter() - start, limiter,
+                            proxy_pool, proxy_url, metrics)
 
+        record_limit(metrics, limiter)
+        if cause is None:
             break
-        except IOError:
-            if sleep_time > 100:
-                return False
-            else:
-                sleep(sleep_time)
-                sleep_time <<= 2
 
-    data = resp.text.split('/*""*/')[0]
+        metrics.inc("google_retries_total", cause=cause)
+
+        if sleep_time > 100:
+            metrics.inc("google_failed_searches_total")
+            return None
+        else:
+            metrics.inc("google_backoff_seconds_total", sleep_time)
+            sleep(sleep_time)
+            sleep_time <<= 2
+
+    if cache is not None and resp.ok:
+        cache.put(params, resp.text)
+
+    return resp.text
+
+
+def release_request(cause, latency, limiter, proxy_pool, proxy_url, metrics):
+    """Finish a try with the limiter and the proxy pool."""
+    outcome = request_outcome(cause)
+    limiter.release(outcome, latency)
+    if proxy_url is not None:
+        proxy_pool.release(proxy_url, outcome, latency)
+        metrics.inc("google_proxy_requests_total",
+                    proxy=proxy_label(proxy_url), outcome=outcome)
+
+
+def record_limit(metrics, limiter):
+    """Record the current concurrency limit (if the requests are limited)."""
+    limit = limiter.current_limit()
+    if limit is not None:
+        metrics.set("google_concurrency_limit", limit)
+
+
+def load_search_info(text):
+    """Return the info array of the first result of a search response."""
+    data = text.split('/*""*/')[0]
 
     # find eof json
     jend = data.rfind("}")
@@ -167,7 +275,21 @@ def get_google_info(place, proxies=None):
     jdata = json.loads(jdata[4:])
 
     # get info from result array, has to be adapted if backend api changes
-    info = index_get(jdata, 0, 1, 0, 14)
+    return index_get(jdata, 0, 1, 0, 14)
+
+
+def parse_search_response(text, search_string, compact=False,
+                          search_url=SEARCH_URL):
+    """Parse the body of a search response.
+
+    :param text: the raw response body
+    :param search_string: the string that was used for the search
+    :param compact: return the popular and waiting times as flat lists of
+        7 * 24 values (see popularity module) instead of lists of days
+    :param search_url: url the search was sent to
+    :return: dict with the google information
+    """
+    info = load_search_info(text)
 
     lat = index_get(info, 9, 2)
     lng = index_get(info, 9, 3)
@@ -192,7 +314,13 @@ def get_google_info(place, proxies=None):
     popular_times, wait_times = None, None
 
     if popular_times_info:
-        popular_times, wait_times = get_popularity_for_day(popular_times_info)
+        if compact:
+            popular_times, wait_times = parse_popularity(popular_times_info)
+            popular_times = popular_times.tolist()
+            wait_times = wait_times.tolist() if any(wait_times) else None
+        else:
+            popular_times, wait_times = get_popularity_for_day(
+                popular_times_info)
 
     # current_popularity is also not available if popular_times isn't
     current_popularity = index_get(info, 84, 7, 1)
@@ -260,40 +388,566 @@ def get_google_info(place, proxies=None):
         if value:
             google_info[target_field] = value
 
+    return google_info
+
+
+def get_uncached_info(place, search_string, search_url=SEARCH_URL):
+    """Return the result for a place that is missing in an offline cache."""
     return dict(
         osm=place,
-        google=google_info,
+        google=dict(search_info=dict(
+            any_info=False,
+            search_string=search_string,
+            search_url=search_url,
+            cache_miss=True,
+        )),
     )
 
 
-def run(places, num_processes=40, proxies=None):
-    pool = Pool(processes=num_processes)
+def get_google_info(place, proxies=None, cache=None, search_url=SEARCH_URL,
+                    compact=False, metrics=NULL_METRICS, limiter=NO_LIMIT,
+                    proxy_pool=None):
+    """Request information for a place and parse current popularity.
+
+    :param place: place, scraped from osm
+    :param cache: optional ResponseCache for the search responses
+    :param search_url: url of the search
+    :param compact: use the compact popularity representation
+    :param metrics: Metrics of the request and the parsing
+    :param limiter: limiter of the concurrency and rate of the requests
+    :param proxy_pool: optional ProxyPool used instead of proxies
+    :return:
+    """
+    search_string = get_search_string(place)
+
+    text = fetch_search_response(search_string, proxies=proxies, cache=cache,
+                                 search_url=search_url, metrics=metrics,
+                                 limiter=limiter, proxy_pool=proxy_pool)
+
+    return parse_fetched(
+        (place, search_string, text, cache is not None and cache.offline),
+        compact=compact, metrics=metrics, search_url=search_url)
+
+
+def parse_fetched(item, compact=False, metrics=NULL_METRICS,
+                  search_url=SEARCH_URL):
+    """Parse a fetched body into a result (second stage of the pipeline).
+
+    :param item: tuple (place, search_string, text, offline)
+    :param compact: use the compact popularity representation
+    :param metrics: Metrics of the parsing
+    :param search_url: url the search was sent to
+    :return: dict with the osm and google information or False
+    """
+    place, search_string, text, offline = item
+
+    if text is None:
+        if offline:
+            return get_uncached_info(place, search_string,
+                                     search_url=search_url)
+        return False
+
+    with metrics.timer("google_parse_seconds"):
+        google = parse_search_response(text, search_string, compact=compact,
+                                       search_url=search_url)
+
+    return dict(osm=place, google=google)
+
+
+def iter_pipeline(places, concurrency=40, parse_processes=None, proxies=None,
+                  cache=None, queue_size=100, search_url=SEARCH_URL,
+                  compact=False, metrics=NULL_METRICS, limiter=NO_LIMIT,
+                  proxy_pool=None, pool=None):
+    """Fetch bodies in threads and parse them in a process pool.
+
+    The threads only wait for the network, the parsing is done by a pool of
+    (by default one per cpu) processes. Both stages are connected by a
+    bounded queue, so fetching pauses when the parsing falls behind.
+
+    :param concurrency: number of fetching threads
+    :param parse_processes: number of parsing processes
+    :param queue_size: maximum number of fetched bodies waiting for (or in)
+        the parsing stage
+    :param metrics: Metrics of both stages (including the queue depth)
+    :param limiter: limiter of the concurrency and rate of the requests
+    :param proxy_pool: optional ProxyPool used instead of proxies
+    :param pool: optional existing process pool used for the parsing
+        (parse_processes is ignored, the pool is not closed)
+    :return: generator of results in the order they are completed (closing
+        it stops the fetching)
+    """
+    bodies = queue.Queue(maxsize=queue_size)
+    parse_slots = threading.Semaphore(queue_size)
+    offline = cache is not None and cache.offline
+    # set when the consumer stops early, the fetching threads stop as well
+    cancelled = threading.Event()
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                bodies.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def fetch(place):
+        if cancelled.is_set():
+            return
+        try:
+            search_string = get_search_string(place)
+            text = fetch_search_response(search_string, proxies=proxies,
+                                         cache=cache, search_url=search_url,
+                                         metrics=metrics, limiter=limiter,
+                                         proxy_pool=proxy_pool)
+            put((place, search_string, text, offline))
+        except BaseException as e:
+            put(e)
+
+    def fetch_all():
+        in_flight = threading.Semaphore(concurrency)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for place in places:
+                in_flight.acquire()
+                if cancelled.is_set():
+                    break
+                future = executor.submit(fetch, place)
+                future.add_done_callback(lambda _: in_flight.release())
+        put(_DONE)
+
+    def iter_bodies():
+        # runs in the task handler thread of the pool, which must not be
+        # blocked after a cancellation (the pool may be used again)
+        while not cancelled.is_set():
+            try:
+                item = bodies.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            metrics.set("google_queue_depth", bodies.qsize(), queue="fetched")
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            # the pool reads its input eagerly, limit the number of bodies
+            # handed over to it
+            while not parse_slots.acquire(timeout=0.1):
+                if cancelled.is_set():
+                    return
+            yield item
+
+    threading.Thread(target=fetch_all, daemon=True).start()
+
+    own_pool = pool is None
+    if own_pool:
+        pool = Pool(processes=parse_processes)
+    parse_func = functools.partial(measure_call, parse_fetched,
+                                   compact=compact, search_url=search_url)
+    results = pool.imap_unordered(parse_func, iter_bodies())
+    completed = False
+    try:
+        for result in iter_merged(results, metrics):
+            parse_slots.release()
+            yield result
+        completed = True
+    finally:
+        cancelled.set()
+        if own_pool:
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+
+
+def iter_slots(places, slots, cancelled):
+    """Yield places, each one only when a slot is free.
+
+    :param slots: threading.Semaphore, released by the consumer of the
+        results
+    :param cancelled: threading.Event, stops the iteration when it is set
+    """
+    places = iter(places)
+    while True:
+        while not slots.acquire(timeout=0.1):
+            if cancelled.is_set():
+                return
+        if cancelled.is_set():
+            return
+        # the next place is only chosen now (e.g. by a PriorityScheduler)
+        place = next(places, None)
+        if place is None:
+            return
+        yield place
+
+
+def google_key(google):
+    """Return the key identifying a google place (None if unknown).
+
+    The place_id is used if available, the browser url otherwise.
+    """
+    return google.get('place_id') or google.get(
+        'search_info', {}).get('browser_url')
+
+
+class Deduplicator:
+    """Merge results that resolve to the same google place.
+
+    The first result of a google place is kept, the OSM places of further
+    results are added to its 'osm_duplicates' list.
+    """
+
+    def __init__(self):
+        """Initialize an empty index."""
+        self.index = dict()
+        self.results = list()
+        self.num_duplicates = 0
+
+    def add(self, place):
+        """Add a result, return False if it is a duplicate."""
+        key = google_key(place['google'])
+
+        if key is None:
+            # nothing to identify the google place with
+            self.results.append(place)
+            return True
+
+        if key in self.index:
+            self.index[key].setdefault('osm_duplicates', []).append(
+                place['osm'])
+            self.num_duplicates += 1
+            return False
+
+        self.index[key] = place
+        self.results.append(place)
+        return True
+
 
-    processed_places = list()
+def iter_deduplicated(places, updates=False):
+    """Merge the results that resolve to the same google place.
+
+    :param updates: if set, the first result of a google place is yielded
+        immediately and every further result as an update record
+        {'duplicate_of': key, 'osm': osm place} (see merge_updates),
+        otherwise the merged results are yielded once all places have been
+        consumed
+    """
+    if updates:
+        # only the keys are kept in memory
+        seen = set()
+        for place in places:
+            key = google_key(place['google'])
+            if key is not None and key in seen:
+                yield dict(duplicate_of=key, osm=place['osm'])
+            else:
+                if key is not None:
+                    seen.add(key)
+                yield place
+        return
+
+    deduplicator = Deduplicator()
+    for place in places:
+        deduplicator.add(place)
+    for place in deduplicator.results:
+        yield place
+
+
+def merge_updates(records, duplicates):
+    """Apply the update records of iter_deduplicated to the places.
+
+    :param records: places and update records
+    :param duplicates: dict of the OSM places of the update records by
+        google key (see collect_updates)
+    :return: generator of the merged places (without update records)
+    """
+    for record in records:
+        if 'duplicate_of' in record:
+            continue
+        key = google_key(record['google'])
+        if key in duplicates:
+            record.setdefault('osm_duplicates', []).extend(duplicates[key])
+        yield record
+
+
+def collect_updates(records):
+    """Return the OSM places of the update records by google key."""
+    duplicates = dict()
+    for record in records:
+        if 'duplicate_of' in record:
+            duplicates.setdefault(record['duplicate_of'], []).append(
+                record['osm'])
+    return duplicates
+
+
+def normalize_search_string(search_string):
+    """Return a search string in lower case with normalized whitespace."""
+    return " ".join(search_string.lower().split())
+
+
+def group_places(places):
+    """Group places by their normalized search string.
+
+    :return: dict with lists of places by normalized search string
+    """
+    groups = dict()
+    for place in places:
+        key = normalize_search_string(get_search_string(place))
+        groups.setdefault(key, []).append(place)
+    return groups
+
+
+def load_journal(path):
+    """Load the results of completed places from a journal.
+
+    :return: dict with the results of the completed places by osm id
+    """
+    completed = dict()
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    place = json.loads(line)
+                except ValueError:
+                    # the line is incomplete if the run has been killed
+                    # while writing it
+                    continue
+                completed[place['osm']['id']] = place
+    except FileNotFoundError:
+        pass
+    return completed
+
+
+def iter_run(places, num_processes=40, proxies=None, engine="pool",
+             concurrency=200, cache=None, journal=None, group_searches=True,
+             parse_processes=None, search_url=SEARCH_URL, compact=False,
+             metrics=NULL_METRICS, limiter=NO_LIMIT, proxy_pool=None,
+             pool=None, store=None, prioritize=False, budget=None):
+    """Run google searches for places and yield results as they complete.
+
+    :param places: places, scraped from osm (any iterable, it is consumed
+        lazily)
+    :param num_processes: number of processes (engine "pool")
+    :param proxies: requests style proxy dict
+    :param engine: "pool" for a process pool, "asyncio" for concurrent
+        requests in a single process or "pipeline" for fetching in threads
+        and parsing in a separate process pool
+    :param concurrency: maximum number of concurrent requests (engines
+        "asyncio" and "pipeline")
+    :param cache: optional ResponseCache for the search responses
+    :param journal: optional path of an append-only journal of completed
+        places; places that are already in the journal are not searched
+        again, their earlier results are yielded instead
+    :param group_searches: search places with the same (normalized) search
+        string only once and use the result for all of them (all places are
+        read before the first search is sent)
+    :param parse_processes: number of parsing processes (engine "pipeline",
+        default: number of cpus)
+    :param search_url: url of the google search (e.g. of a local test
+        server)
+    :param compact: return the popular and waiting times as flat lists of
+        7 * 24 values instead of lists of days (see popularity module)
+    :param metrics: Metrics of the searches (see metrics module), flushed
+        periodically and at the end
+    :param limiter: limiter of the concurrency and rate of the requests
+        (e.g. limiter.AdaptiveLimiter, its maximum limit should not exceed
+        num_processes or concurrency)
+    :param proxy_pool: optional ProxyPool (see proxies module), the requests
+        are spread across its proxies instead of using proxies
+    :param pool: optional existing process pool, used for the searches
+        (engine "pool") or the parsing (engine "pipeline") instead of
+        creating a new one; it is not closed, so it can be used for many
+        runs (see cli.scrape_files). With engine "pool", the limiter and the
+        proxy pool have to be shared already (see limiter.share).
+    :param store: optional store.ObservationStore, the current popularity
+        (and the popular times) of every searched place is appended to it
+    :param prioritize: search the places in the order of their expected
+        value, estimated from their tags and the hit rates of the run (see
+        priority module; all places are read before the first search is
+        sent)
+    :param budget: maximum number of searches (None: no limit), the other
+        places are not searched and not yielded
+    :return: generator of dicts with the osm and google information; closing
+        it early (generator.close) stops the searches
+    :raises SearchFailedError: if a search failed (after its retries)
+    """
+    completed = dict()
+    total = len(places) if hasattr(places, '__len__') else None
+
+    if journal is not None:
+        completed = load_journal(journal)
+        places = (p for p in places if p['id'] not in completed)
+
+        # yield results of the previous runs first
+        for place in completed.values():
+            yield place
+
+        journal_file = open(journal, 'a')
+        # start on a new line after an incomplete last line
+        if journal_file.tell() > 0:
+            journal_file.write("\n")
+
+    groups = None
+    if group_searches:
+        groups = group_places(places)
+        # only search the first place of every group
+        places = [group[0] for group in groups.values()]
+
+    scheduler = None
+    if prioritize:
+        def weight(place):
+            # a search counts for all places of its group
+            return len(groups[normalize_search_string(
+                get_search_string(place))])
+
+        scheduler = PriorityScheduler(
+            places, weight=None if groups is None else weight, budget=budget)
+        places = iter(scheduler)
+    elif budget is not None:
+        places = itertools.islice(places, budget)
+
+    manager = None
+    slots = None
+    cancelled = threading.Event()
+    if engine == "asyncio":
+        # optional dependency, only import when it is used
+        from power_places_scraper.google_async import iter_google_info
+        results = iter_google_info(places, concurrency=concurrency,
+                                   proxies=proxies, cache=cache,
+                                   search_url=search_url, compact=compact,
+                                   metrics=metrics, limiter=limiter,
+                                   proxy_pool=proxy_pool)
+    elif engine == "pipeline":
+        results = iter_pipeline(places, concurrency=concurrency,
+                                parse_processes=parse_processes,
+                                proxies=proxies, cache=cache,
+                                search_url=search_url, compact=compact,
+                                metrics=metrics, limiter=limiter,
+                                proxy_pool=proxy_pool, pool=pool)
+    elif engine == "pool":
+        own_pool = pool is None
+        if own_pool:
+            pool = Pool(processes=num_processes)
+        # the workers share the limiter and the proxy pool via a manager
+        # process
+        (limiter, proxy_pool), manager = share(limiter, proxy_pool)
+        # the workers return their metrics together with the results
+        search_func = functools.partial(measure_call, get_google_info,
+                                        proxies=proxies, cache=cache,
+                                        search_url=search_url,
+                                        compact=compact, limiter=limiter,
+                                        proxy_pool=proxy_pool)
+        # the pool reads its input eagerly, a place is only handed over
+        # when there is a free slot (so the scheduler uses the latest hit
+        # rates and closing the generator stops the searches soon)
+        slots = threading.Semaphore(2 * num_processes)
+        results = iter_merged(
+            pool.imap_unordered(search_func,
+                                iter_slots(places, slots, cancelled)),
+            metrics)
+    else:
+        raise ValueError("Unknown engine '{}'.".format(engine))
 
     num_places_with_gpt = 0
     num_search_results = 0
+    num_grouped = 0
+    num_places = 0
 
-    search_func = functools.partial(get_google_info, proxies=proxies)
+    metrics.inc("google_places_total", len(completed), source="journal")
 
-    with tqdm(pool.imap_unordered(search_func, places), unit="places",
-              total=len(places)) as bar:
-        for place in bar:
-            if not place:
-                bar.write("Check proxy!")
-                quit()
+    completed_run = False
+    try:
+        with tqdm(unit="places", total=total, initial=len(completed)) as bar:
+            for result in results:
+                if slots is not None:
+                    slots.release()
+
+                if not result:
+                    raise SearchFailedError(
+                        "A google search failed, check the proxy.")
+
+                group = [result]
+                if groups is not None:
+                    search_string = result['google']['search_info'][
+                        'search_string']
+                    # use the result for the other places of the group
+                    group.extend(
+                        dict(osm=place, google=dict(result['google']))
+                        for place in groups.pop(
+                            normalize_search_string(search_string))[1:])
+                    num_grouped += len(group) - 1
+                    metrics.inc("google_places_total", len(group) - 1,
+                                source="grouped")
+
+                metrics.inc("google_places_total", source="searched")
+
+                google = result['google']
+                if scheduler is not None:
+                    scheduler.record(result['osm'], google)
+
+                if store is not None and google.get('place_id'):
+                    store.append(google['place_id'], time.time(),
+                                 google.get('current_popularity'),
+                                 popular_times=google.get('popular_times'))
+
+                for place in group:
+                    if place['google']['search_info']['any_info']:
+                        num_search_results += 1
+
+                    if 'popular_times' in place['google']:
+                        num_places_with_gpt += 1
+
+                    if journal is not None:
+                        journal_file.write(json.dumps(place))
+                        journal_file.write("\n")
+                        journal_file.flush()
+
+                    yield place
+
+                num_places += len(group)
+                metrics.set("google_success_ratio",
+                            num_search_results / num_places)
+                metrics.set("google_popular_times_ratio",
+                            num_places_with_gpt / num_places)
+                metrics.maybe_flush()
+
+                bar.update(len(group))
+                postfix = {
+                    'search results': num_search_results,
+                    'with gpt': num_places_with_gpt,
+                }
+                if groups is not None:
+                    postfix['grouped'] = num_grouped
+                bar.set_postfix(postfix)
+        completed_run = True
+    finally:
+        # also runs when the consumer closes the generator early or a
+        # search failed: stop handing out places and the searches in flight
+        cancelled.set()
+        results.close()
+
+        if journal is not None:
+            journal_file.close()
+
+        if manager is not None:
+            manager.shutdown()
+
+        if engine == "pool" and own_pool:
+            if completed_run:
+                pool.close()
+            else:
+                pool.terminate()
 
-            processed_places.append(place)
+        if completed_run and cache is not None:
+            cache.evict()
 
-            if place['google']['search_info']['any_info']:
-                num_search_results += 1
+        metrics.flush()
 
-            if 'popular_times' in place['google']:
-                num_places_with_gpt += 1
 
-            bar.set_postfix({
-                'search results': num_search_results,
-                'with gpt': num_places_with_gpt,
-            })
+def run(places, deduplicate=False, **params):
+    """Run google searches for places (see iter_run for the parameters).
 
-    return processed_places
+    :param deduplicate: merge results that resolve to the same
+        google place (see Deduplicator)
+    :return: list of dicts with the osm and google information
+    """
+    results = iter_run(places, **params)
+    if deduplicate:
+        results = iter_deduplicated(results)
+    return list(results)
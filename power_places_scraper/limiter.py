@@ -0,0 +1,192 @@
+"""Adaptive limit of the concurrency and rate of the google requests.
+
+The limiter raises the number of concurrent requests additively while the
+requests succeed with a healthy latency and cuts it multiplicatively when
+google throttles the requests (additive increase, multiplicative decrease).
+Independently of the concurrency, a token bucket limits the request rate.
+"""
+
+import asyncio
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+
+class NoLimit:
+    """Limiter that does not limit the requests."""
+
+    def try_acquire(self):
+        """Start a request if possible.
+
+        :return: None if the request may start, otherwise the number of
+            seconds to wait before trying again
+        """
+        return None
+
+    def acquire(self):
+        """Block until a request may start."""
+
+    async def acquire_async(self):
+        """Wait (without blocking the event loop) until a request may start."""
+
+    def release(self, outcome, latency=None):
+        """Finish a request.
+
+        :param outcome: "ok", "throttled" or "error"
+        :param latency: seconds until the response arrived
+        """
+
+    def current_limit(self):
+        """Return the current number of allowed concurrent requests."""
+        return None
+
+
+NO_LIMIT = NoLimit()
+
+
+class AdaptiveLimiter(NoLimit):
+    """AIMD limit of concurrent requests together with a token bucket."""
+
+    def __init__(self, max_limit=200, min_limit=1, initial_limit=None,
+                 decrease_factor=0.5, max_latency=5.0, cooldown=5.0,
+                 rate=None, burst=None):
+        """Initialize the limiter.
+
+        :param max_limit: maximum number of concurrent requests
+        :param min_limit: minimum number of concurrent requests
+        :param initial_limit: number of concurrent requests to start with
+            (default: min(10, max_limit))
+        :param decrease_factor: factor the limit is cut by when throttled
+        :param max_latency: only raise the limit while the latency of the
+            successful requests stays below this number of seconds
+        :param cooldown: minimum number of seconds between two cuts (the
+            throttled responses of one burst only cut the limit once)
+        :param rate: maximum number of requests per second (None: no limit)
+        :param burst: size of the token bucket (default: one second of rate)
+        """
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial_limit if initial_limit is not None
+                           else min(10, max_limit))
+        self.decrease_factor = decrease_factor
+        self.max_latency = max_latency
+        self.cooldown = cooldown
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate or 1)
+
+        self.in_flight = 0
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.last_cut = None
+        self.condition = threading.Condition()
+
+    def refill(self, now):
+        """Add the tokens of the time since the last refill."""
+        if self.rate is None:
+            return
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def try_acquire(self):
+        """Start a request if possible (see NoLimit.try_acquire)."""
+        with self.condition:
+            return self._try_acquire()
+
+    def _try_acquire(self):
+        """Start a request if possible (the condition must be held)."""
+        if self.in_flight >= int(self.limit):
+            # woken up by release, the timeout is a fallback
+            return 1.0
+
+        now = time.monotonic()
+        self.refill(now)
+        if self.rate is not None and self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+
+        if self.rate is not None:
+            self.tokens -= 1
+        self.in_flight += 1
+        return None
+
+    def acquire(self):
+        """Block until a request may start."""
+        with self.condition:
+            while True:
+                wait_time = self._try_acquire()
+                if wait_time is None:
+                    return
+                self.condition.wait(wait_time)
+
+    async def acquire_async(self):
+        """Wait (without blocking the event loop) until a request may start."""
+        while True:
+            wait_time = self.try_acquire()
+            if wait_time is None:
+                return
+            await asyncio.sleep(min(wait_time, 0.05))
+
+    def release(self, outcome, latency=None):
+        """Finish a request and adapt the limit to its outcome."""
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+
+            if outcome == "throttled":
+                if self.last_cut is None or now - self.last_cut >= \
+                        self.cooldown:
+                    self.limit = max(self.min_limit,
+                                     self.limit * self.decrease_factor)
+                    self.last_cut = now
+            elif outcome == "ok" and (latency is None
+                                      or latency <= self.max_latency):
+                # about one more request per round trip of all requests
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+    def current_limit(self):
+        """Return the current number of allowed concurrent requests."""
+        with self.condition:
+            return int(self.limit)
+
+    # name of the class in the manager (see share)
+    shared_name = "AdaptiveLimiter"
+
+    @property
+    def params(self):
+        """Return the parameters to create a limiter with the same settings."""
+        return dict(max_limit=self.max_limit, min_limit=self.min_limit,
+                    initial_limit=self.limit,
+                    decrease_factor=self.decrease_factor,
+                    max_latency=self.max_latency, cooldown=self.cooldown,
+                    rate=self.rate, burst=self.burst)
+
+
+class SharedManager(BaseManager):
+    """Manager that shares limiters (and proxy pools) between processes."""
+
+
+SharedManager.register("AdaptiveLimiter", AdaptiveLimiter, exposed=(
+    "try_acquire", "acquire", "release", "current_limit"))
+
+
+def share(*objects):
+    """Return objects that can be used by the workers of a process pool.
+
+    Objects with a shared_name are replaced by a copy (with the same
+    settings) in a manager process, other objects are returned unchanged.
+
+    :return: tuple (list of objects, manager or None), the manager has to be
+        shut down after the run
+    """
+    if not any(hasattr(o, 'shared_name') for o in objects):
+        return list(objects), None
+
+    manager = SharedManager()
+    manager.start()
+    return [
+        getattr(manager, o.shared_name)(**o.params)
+        if hasattr(o, 'shared_name') else o
+        for o in objects
+    ], manager
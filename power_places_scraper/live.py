@@ -0,0 +1,224 @@
+"""Polling of the current popularity of already scraped places.
+
+The current popularity is the only live information of the google search.
+Instead of running the whole scraping again, the places with popular times
+are loaded from an output file and searched again in rounds, and only the
+live fields of the responses are parsed. Every round polls the places with
+the highest priority: places that are open at the current hour (according
+to their popular times) and whose current popularity changes often.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from power_places_scraper.google_scraper import (
+    SEARCH_URL, fetch_search_response, load_search_info, index_get)
+from power_places_scraper.popularity import to_array, NUM_HOURS
+from power_places_scraper.metrics import NULL_METRICS
+from power_places_scraper.limiter import NO_LIMIT
+
+
+# seconds between the starts of two rounds
+DEFAULT_INTERVAL = 15 * 60
+
+# weight of the latest poll in the change rate of a place
+CHANGE_ALPHA = 0.3
+
+# places whose current popularity did not change are still polled sometimes
+MIN_CHANGE_RATE = 0.05
+
+# places whose search found another place this many times in a row are not
+# polled anymore (the priority is halved with every mismatch before)
+MAX_MISMATCHES = 3
+
+
+def parse_live_response(text):
+    """Parse only the live fields of a search response.
+
+    :return: dict with the place_id and the current_popularity
+    """
+    info = load_search_info(text)
+    return dict(place_id=index_get(info, 78),
+                current_popularity=index_get(info, 84, 7, 1))
+
+
+class LivePlace:
+    """A polled place with the statistics of its observations."""
+
+    def __init__(self, place):
+        """Initialize from a place of an output file (with popular times)."""
+        google = place['google']
+        self.osm_id = place['osm']['id']
+        self.place_id = google.get('place_id')
+        self.search_string = google['search_info']['search_string']
+        self.weekly = to_array(google['popular_times'])
+        self.value = None
+        self.change_rate = 1.0
+        self.num_polls = 0
+        self.num_mismatches = 0
+        self.last_round = None
+
+    def expected_popularity(self, now):
+        """Return the usual popularity at a time (struct_time, local)."""
+        return self.weekly[now.tm_wday * NUM_HOURS + now.tm_hour]
+
+    def priority(self, now, round_no):
+        """Return the priority of polling the place in a round.
+
+        Places without visitors at the current hour (usually because they
+        are closed) are not polled. Otherwise, the priority grows with the
+        usual popularity, the change rate and the rounds since the last poll.
+        """
+        expected = self.expected_popularity(now)
+        if expected == 0 or self.num_mismatches >= MAX_MISMATCHES:
+            return 0.0
+        age = round_no + 1 if self.last_round is None else \
+            round_no - self.last_round
+        return (expected / 100 * max(self.change_rate, MIN_CHANGE_RATE) * age
+                / 2 ** self.num_mismatches)
+
+    def attempted(self, round_no, mismatch=False):
+        """Record a poll without an observation (failed or another place).
+
+        The rounds since the last poll start again, so failing places do
+        not push the others out of the following rounds.
+        """
+        self.last_round = round_no
+        if mismatch:
+            self.num_mismatches += 1
+
+    def update(self, value, round_no):
+        """Update the change rate with a new observation."""
+        if self.num_polls > 0:
+            changed = 1.0 if value != self.value else 0.0
+            self.change_rate += CHANGE_ALPHA * (changed - self.change_rate)
+        self.value = value
+        self.num_polls += 1
+        self.num_mismatches = 0
+        self.last_round = round_no
+
+
+def iter_live_places(places):
+    """Yield LivePlaces for the places with popular times."""
+    for place in places:
+        google = place.get('google') or {}
+        if google.get('popular_times') and google.get('search_info'):
+            yield LivePlace(place)
+
+
+class LivePoller:
+    """Poll the current popularity of places in rounds."""
+
+    def __init__(self, places, interval=DEFAULT_INTERVAL, max_requests=None,
+                 concurrency=10, proxies=None, search_url=SEARCH_URL,
+                 metrics=NULL_METRICS, limiter=NO_LIMIT, proxy_pool=None,
+                 utc_offset=None):
+        """Initialize the poller.
+
+        :param places: places of an output file (places without popular
+            times are skipped)
+        :param interval: seconds between the starts of two rounds
+        :param max_requests: maximum number of places polled per round
+            (None: all places that are open)
+        :param concurrency: number of concurrent searches
+        :param utc_offset: offset of the local time of the places in hours
+            (None: local time of this machine), used for the opening hours
+        """
+        self.places = list(iter_live_places(places))
+        self.interval = interval
+        self.max_requests = max_requests
+        self.concurrency = concurrency
+        self.proxies = proxies
+        self.search_url = search_url
+        self.metrics = metrics
+        self.limiter = limiter
+        self.proxy_pool = proxy_pool
+        self.utc_offset = utc_offset
+        self.round_no = 0
+
+    def local_time(self, timestamp):
+        """Return the local time of the places."""
+        if self.utc_offset is None:
+            return time.localtime(timestamp)
+        return time.gmtime(timestamp + self.utc_offset * 3600)
+
+    def select(self, timestamp):
+        """Return the places polled in the current round (by priority)."""
+        now = self.local_time(timestamp)
+        ranked = sorted(
+            ((place.priority(now, self.round_no), i, place)
+             for i, place in enumerate(self.places)),
+            key=lambda item: item[:2], reverse=True)
+        selected = [place for priority, _, place in ranked if priority > 0]
+        return selected[:self.max_requests]
+
+    def poll(self, place):
+        """Search a place again and return the observation.
+
+        :return: tuple (result, observation), result is "ok", "failed" or
+            "other_place", observation is a dict with the ids, the time and
+            the current popularity (None unless the result is "ok")
+        """
+        text = fetch_search_response(
+            place.search_string, proxies=self.proxies,
+            search_url=self.search_url, metrics=self.metrics,
+            limiter=self.limiter, proxy_pool=self.proxy_pool)
+
+        if text is None:
+            self.metrics.inc("live_polls_total", result="failed")
+            return "failed", None
+
+        live = parse_live_response(text)
+        if place.place_id is not None and live['place_id'] != place.place_id:
+            self.metrics.inc("live_polls_total", result="other_place")
+            return "other_place", None
+
+        self.metrics.inc("live_polls_total", result="ok")
+        return "ok", dict(osm_id=place.osm_id, place_id=place.place_id,
+                          time=time.time(),
+                          current_popularity=live['current_popularity'])
+
+    def iter_round(self):
+        """Poll the selected places and yield the observations."""
+        selected = self.select(time.time())
+        self.metrics.set("live_selected_places", len(selected))
+
+        if selected:
+            workers = min(self.concurrency, len(selected))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(self.poll, place): place
+                           for place in selected}
+                for future in as_completed(futures):
+                    place = futures[future]
+                    try:
+                        result, observation = future.result()
+                    except Exception as e:
+                        # e.g. an error page or a malformed body, a single
+                        # place does not end the polling
+                        self.metrics.inc("live_polls_total", result="error")
+                        print("WARNING: Polling '{}' failed: {!r}".format(
+                            place.search_string, e))
+                        result, observation = "error", None
+                    if observation is None:
+                        place.attempted(self.round_no,
+                                        mismatch=result == "other_place")
+                    else:
+                        place.update(observation['current_popularity'],
+                                     self.round_no)
+                        yield observation
+
+        self.round_no += 1
+
+    def run(self, callback, rounds=None):
+        """Poll in rounds and call callback with every observation.
+
+        :param rounds: number of rounds (None: poll until interrupted)
+        """
+        while rounds is None or self.round_no < rounds:
+            start = time.time()
+            with self.metrics.timer("live_round_seconds"):
+                for observation in self.iter_round():
+                    callback(observation)
+            self.metrics.flush()
+            if rounds is None or self.round_no < rounds:
+                time.sleep(max(0, start + self.interval - time.time()))
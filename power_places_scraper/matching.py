@@ -0,0 +1,191 @@
+"""Matching of OSM places with the places returned by the google search.
+
+The google search does not necessarily return the OSM place that was looked
+up. The OSM place is therefore compared with all google places nearby (by
+distance and name similarity) and every record gets a match confidence.
+"""
+
+from collections import defaultdict
+from difflib import SequenceMatcher
+import math
+import re
+
+from power_places_scraper.google_scraper import google_key
+
+
+# approximate length of a degree of latitude in meters
+METERS_PER_DEGREE = 111320
+
+# default maximum distance between OSM place and google place in meters
+DEFAULT_RADIUS = 100
+
+# weight of the name similarity in the confidence (the rest is distance)
+NAME_WEIGHT = 0.6
+
+NON_WORD_CHARS = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """Return the approximate distance between two positions in meters."""
+    d_lat = lat2 - lat1
+    d_lng = (lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    return math.hypot(d_lat, d_lng) * METERS_PER_DEGREE
+
+
+def normalize_name(name):
+    """Return a lower case name without punctuation."""
+    return NON_WORD_CHARS.sub(" ", name or "").strip().lower()
+
+
+def name_similarity(matcher, name, osm_name):
+    """Return the similarity of two normalized names between 0 and 1.
+
+    :param matcher: SequenceMatcher with osm_name as its second sequence
+    """
+    if not name or not osm_name:
+        return 0
+    if name == osm_name:
+        return 1
+    matcher.set_seq1(name)
+    return matcher.ratio()
+
+
+class GridIndex:
+    """Spatial index of items in grid cells of a fixed size.
+
+    Looking up the items near a position only checks the surrounding cells,
+    so matching n places takes roughly linear time.
+    """
+
+    def __init__(self, radius=DEFAULT_RADIUS):
+        """Initialize an index for lookups within radius meters."""
+        self.radius = radius
+        self.cell_size = radius / METERS_PER_DEGREE
+        self.cells = defaultdict(list)
+
+    def cell(self, lat, lng):
+        """Return the cell of a position."""
+        return int(lat // self.cell_size), int(lng // self.cell_size)
+
+    def add(self, lat, lng, item):
+        """Add an item at a position."""
+        self.cells[self.cell(lat, lng)].append((lat, lng, item))
+
+    def nearby(self, lat, lng):
+        """Yield (distance, item) for all items within the radius."""
+        row, col = self.cell(lat, lng)
+
+        # cells are narrower (in meters) along the longitude
+        num_cols = math.ceil(1 / max(math.cos(math.radians(lat)), 0.01))
+
+        for i in range(row - 1, row + 2):
+            for j in range(col - num_cols, col + num_cols + 1):
+                for item_lat, item_lng, item in self.cells.get((i, j), ()):
+                    d = distance(lat, lng, item_lat, item_lng)
+                    if d <= self.radius:
+                        yield d, item
+
+
+def build_index(records, radius=DEFAULT_RADIUS):
+    """Build a spatial index of the google places of records.
+
+    Every google place is only added once (identified by its place_id).
+    """
+    index = GridIndex(radius)
+    seen = set()
+
+    for record in records:
+        google = record['google']
+        position = google.get('position', {})
+        lat, lng = position.get('lat'), position.get('lng')
+
+        if lat is None or lng is None:
+            continue
+
+        key = google_key(google)
+        if key is not None:
+            if key in seen:
+                continue
+            seen.add(key)
+
+        index.add(lat, lng, (key, normalize_name(google.get('name'))))
+
+    return index
+
+
+def confidence(d, similarity, radius):
+    """Combine distance and name similarity to a confidence."""
+    closeness = max(0, 1 - d / radius)
+    return NAME_WEIGHT * similarity + (1 - NAME_WEIGHT) * closeness
+
+
+def match_record(record, index):
+    """Add the match information to a record.
+
+    The 'match' dict contains the confidence that the google result belongs
+    to the OSM place, and the best matching google place nearby (if it is
+    another one).
+    """
+    osm, google = record['osm'], record['google']
+    osm_name = normalize_name(osm['tags'].get('name'))
+
+    # the osm name is compared with all candidates, so it is the sequence
+    # that the matcher analyses once
+    matcher = SequenceMatcher(None, "", osm_name)
+
+    match = dict(confidence=0)
+
+    position = google.get('position', {})
+    if position.get('lat') is not None and position.get('lng') is not None:
+        d = distance(osm['lat'], osm['lng'], position['lat'], position['lng'])
+        similarity = name_similarity(
+            matcher, normalize_name(google.get('name')), osm_name)
+        match.update(
+            confidence=round(confidence(d, similarity, index.radius), 3),
+            distance=round(d, 1),
+            name_similarity=round(similarity, 3),
+        )
+
+    # compare with all other google places nearby, closest first, until
+    # even a perfect name match could not beat the best candidate
+    own_key = google_key(google)
+    best = None
+
+    for d, (key, name) in sorted(index.nearby(osm['lat'], osm['lng']),
+                                 key=lambda c: c[0]):
+        if key is not None and key == own_key:
+            continue
+
+        threshold = match['confidence'] if best is None else best[0]
+        if confidence(d, 1, index.radius) <= threshold:
+            break
+
+        if not osm_name or not name:
+            similarity = 0
+        elif osm_name == name:
+            similarity = 1
+        else:
+            matcher.set_seq1(name)
+            similarity = matcher.real_quick_ratio()
+            # only compute the exact ratio if it can beat the threshold
+            if confidence(d, similarity, index.radius) > threshold:
+                similarity = matcher.quick_ratio()
+            if confidence(d, similarity, index.radius) > threshold:
+                similarity = matcher.ratio()
+
+        score = confidence(d, similarity, index.radius)
+        if score > threshold:
+            best = score, key
+
+    if best is not None and best[1]:
+        match['best_place_id'] = best[1]
+        match['best_confidence'] = round(best[0], 3)
+
+    record['match'] = match
+    return record
+
+
+def match_places(records, radius=DEFAULT_RADIUS):
+    """Add match information to a list of records (see match_record)."""
+    index = build_index(records, radius=radius)
+    return [match_record(record, index) for record in records]
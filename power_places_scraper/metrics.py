@@ -0,0 +1,279 @@
+"""Metrics of the OSM and google scraping.
+
+Counters, gauges and histograms are recorded in a Metrics object and written
+to its sinks (a json-lines file, a Prometheus textfile or a callback) at a
+fixed interval and at the end of a run.
+
+Measurements in worker processes are recorded in a separate Metrics object,
+whose data is merged into the one of the main process (see measure_call).
+"""
+
+import bisect
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+# upper bounds of the histogram buckets (in seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120)
+
+DEFAULT_INTERVAL = 10
+
+
+class NullMetrics:
+    """Metrics that are not recorded."""
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter."""
+
+    def set(self, name, value, **labels):
+        """Set a gauge."""
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram."""
+
+    def timer(self, name, **labels):
+        """Return a context manager that observes its duration."""
+        return contextlib.nullcontext()
+
+    def merge(self, data):
+        """Merge the data of other metrics."""
+
+    def maybe_flush(self):
+        """Flush if the interval has passed."""
+
+    def flush(self):
+        """Write the metrics to the sinks."""
+
+
+NULL_METRICS = NullMetrics()
+
+
+class Metrics(NullMetrics):
+    """Thread-safe store of counters, gauges and histograms."""
+
+    def __init__(self, sinks=(), interval=DEFAULT_INTERVAL,
+                 buckets=DEFAULT_BUCKETS):
+        """Initialize empty metrics.
+
+        :param sinks: sinks (or callables) the metrics are written to
+        :param interval: minimum number of seconds between two flushes
+        :param buckets: upper bounds of the histogram buckets
+        """
+        self.sinks = [s if hasattr(s, 'write') else CallbackSink(s)
+                      for s in sinks]
+        self.interval = interval
+        self.buckets = tuple(buckets)
+        self.types = dict()
+        self.values = dict()
+        self.lock = threading.Lock()
+        # serializes the flushes (the sinks are not thread-safe)
+        self.flush_lock = threading.Lock()
+        self.last_flush = time.time()
+
+    @staticmethod
+    def key(name, labels):
+        """Return the key of a metric with labels."""
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter."""
+        key = self.key(name, labels)
+        with self.lock:
+            self.types[name] = "counter"
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge."""
+        with self.lock:
+            self.types[name] = "gauge"
+            self.values[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram."""
+        key = self.key(name, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.types[name] = "histogram"
+            if key not in self.values:
+                # counts per bucket (the last one is +Inf), sum and count
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            histogram = self.values[key]
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Return a context manager that observes its duration."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def export(self):
+        """Return the (picklable) data of the metrics."""
+        with self.lock:
+            return dict(types=dict(self.types), values={
+                key: ([list(v[0]), v[1], v[2]] if isinstance(v, list) else v)
+                for key, v in self.values.items()
+            })
+
+    def merge(self, data):
+        """Merge the data of other metrics (with the same buckets)."""
+        with self.lock:
+            self.types.update(data['types'])
+            for key, value in data['values'].items():
+                kind = data['types'][key[0]]
+                if kind == "gauge" or key not in self.values:
+                    self.values[key] = value
+                elif kind == "counter":
+                    self.values[key] += value
+                else:
+                    histogram = self.values[key]
+                    histogram[0] = [a + b for a, b in zip(histogram[0],
+                                                          value[0])]
+                    histogram[1] += value[1]
+                    histogram[2] += value[2]
+
+    def snapshot(self):
+        """Return the current values as a json serializable dict."""
+        data = self.export()
+        metrics = dict()
+        for (name, labels), value in sorted(data['values'].items()):
+            sample = dict(labels=dict(labels))
+            if data['types'][name] == "histogram":
+                counts, total, count = value
+                bounds = [str(b) for b in self.buckets] + ["+Inf"]
+                sample.update(buckets=dict(zip(bounds, counts)), sum=total,
+                              count=count)
+            else:
+                sample['value'] = value
+            metrics.setdefault(name, dict(
+                type=data['types'][name], samples=list()))[
+                    'samples'].append(sample)
+        return dict(time=time.time(), metrics=metrics)
+
+    def maybe_flush(self):
+        """Flush if the interval has passed."""
+        with self.flush_lock:
+            if time.time() - self.last_flush >= self.interval:
+                self.write_sinks()
+
+    def flush(self):
+        """Write the metrics to the sinks."""
+        with self.flush_lock:
+            self.write_sinks()
+
+    def write_sinks(self):
+        """Write a snapshot to the sinks (with the flush lock held)."""
+        self.last_flush = time.time()
+        if not self.sinks:
+            return
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.write(snapshot)
+
+
+def measure_call(func, *args, **kwargs):
+    """Call func with separate metrics (e.g. in a worker process).
+
+    :return: tuple (result, data of the metrics)
+    """
+    metrics = Metrics()
+    result = func(*args, metrics=metrics, **kwargs)
+    return result, metrics.export()
+
+
+def iter_merged(results, metrics):
+    """Merge the metrics of results of measure_call and yield the results."""
+    for result, data in results:
+        metrics.merge(data)
+        yield result
+
+
+class CallbackSink:
+    """Pass every snapshot to a callback."""
+
+    def __init__(self, callback):
+        """Initialize with the callback."""
+        self.callback = callback
+
+    def write(self, snapshot):
+        """Call the callback with a snapshot."""
+        self.callback(snapshot)
+
+
+class JsonLinesSink:
+    """Append every snapshot as a line to a json-lines file."""
+
+    def __init__(self, path):
+        """Initialize with the path of the file."""
+        self.path = path
+
+    def write(self, snapshot):
+        """Append a snapshot."""
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(snapshot))
+            f.write("\n")
+
+
+def format_labels(labels, **extra):
+    """Return labels in the Prometheus text format."""
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + "}"
+
+
+class PrometheusTextfileSink:
+    """Write the latest snapshot to a file in the Prometheus text format.
+
+    The file can be collected by the textfile collector of the node
+    exporter, it is replaced atomically.
+    """
+
+    def __init__(self, path, prefix="power_places_"):
+        """Initialize with the path of the file and a prefix of the names."""
+        self.path = path
+        self.prefix = prefix
+
+    def format(self, snapshot):
+        """Return a snapshot in the Prometheus text format."""
+        lines = list()
+        for name, metric in snapshot['metrics'].items():
+            name = self.prefix + name
+            lines.append("# TYPE {} {}".format(name, metric['type']))
+            for sample in metric['samples']:
+                labels = sample['labels']
+                if metric['type'] != "histogram":
+                    lines.append("{}{} {}".format(
+                        name, format_labels(labels), sample['value']))
+                    continue
+                cumulative = 0
+                for bound, count in sample['buckets'].items():
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(
+                        name, format_labels(labels, le=bound), cumulative))
+                lines.append("{}_sum{} {}".format(
+                    name, format_labels(labels), sample['sum']))
+                lines.append("{}_count{} {}".format(
+                    name, format_labels(labels), sample['count']))
+        return "\n".join(lines) + "\n"
+
+    def write(self, snapshot):
+        """Replace the file with a snapshot."""
+        # a unique temporary file in the same directory (os.replace does
+        # not work across file systems)
+        with tempfile.NamedTemporaryFile(
+                'w', dir=os.path.dirname(os.path.abspath(self.path)),
+                prefix=os.path.basename(self.path) + ".", suffix=".tmp",
+                delete=False) as f:
+            f.write(self.format(snapshot))
+        os.replace(f.name, self.path)
@@ -3,7 +3,22 @@
 from tqdm import tqdm
 import overpy
 from time import sleep
-import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.error import HTTPError
+from urllib.request import urlopen
+import codecs
+import json
+import threading
+import time
+import re
+
+from power_places_scraper.metrics import NULL_METRICS
+from power_places_scraper.cache import TILE_SPLIT
+from power_places_scraper.places import tag_projection, project_tags
+from power_places_scraper.query import compile_filters, build_query
+from power_places_scraper.geometry import (
+    tiles_in, tile_bounding_box, child_tiles, box_contains)
 
 
 DEFAULT_TAG_FILTER_OBJECTS = [
@@ -13,64 +28,165 @@ DEFAULT_TAG_FILTER_OBJECTS = [
     {"name": None, "addr:street": None}
 ]
 
+# zoom level of the map tiles when using a tile cache (tiles are about 5 km
+# wide at the equator and 3 km wide in central Europe)
+DEFAULT_TILE_ZOOM = 13
+
+# number of bytes read at once when streaming a response
+CHUNK_SIZE = 64 * 1024
+
+# remark of an Overpass json response (e.g. a runtime error)
+REMARK = re.compile(r'"remark"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+# seconds the status of an Overpass server is reused for
+STATUS_TTL = 5
+
+
+class OverpassSlots:
+    """Wait for free query slots of an Overpass server.
+
+    The server reports its rate limit and the time until the next slot is
+    available at /api/status (next to /api/interpreter). The status is
+    reused for STATUS_TTL seconds, the slots taken since it was requested
+    are counted locally.
+    """
+
+    def __init__(self, url):
+        """Initialize for the url of the interpreter of the server."""
+        self.status_url = url.rsplit("/", 1)[0] + "/status"
+        self.lock = threading.Lock()
+        self.last_status = None
+        self.status_time = None
+        # slots taken since the last status was requested
+        self.num_reserved = 0
+
+    def status(self):
+        """Return the rate limit, free slots and seconds until next slot.
+
+        :return: tuple (rate_limit, num_available, wait_time) or None if the
+            status is not available
+        """
+        try:
+            with urlopen(self.status_url, timeout=10) as f:
+                text = f.read().decode("utf-8")
+        except (IOError, ValueError):
+            return None
+
+        rate_limit = re.search(r"Rate limit: (\d+)", text)
+        if rate_limit is None:
+            return None
+
+        available = re.search(r"(\d+) slots? available now", text)
+        waits = [int(w) for w in re.findall(r"in (-?\d+) seconds", text)]
+
+        return (
+            int(rate_limit.group(1)),
+            int(available.group(1)) if available else 0,
+            max(min(waits), 0) if waits else 1,
+        )
+
+    def acquire(self):
+        """Block until the server has a free slot for a query.
+
+        :return: False if the status of the server is not available
+        """
+        # slots are taken one at a time and counted until the next status,
+        # so two workers do not take the same free slot (a query sent just
+        # before a status request may not be counted by the server yet, it
+        # is answered with 429 and retried then)
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                if (self.status_time is None
+                        or now - self.status_time > STATUS_TTL):
+                    self.last_status = self.status()
+                    self.status_time = now
+                    self.num_reserved = 0
+
+                if self.last_status is None:
+                    return False
+
+                rate_limit, available, wait_time = self.last_status
+                # a rate limit of 0 means there is no limit
+                if rate_limit == 0:
+                    return True
+                if available - self.num_reserved > 0:
+                    self.num_reserved += 1
+                    return True
+
+                sleep(wait_time + 1)
+                # the waiting time has passed, the status is outdated
+                self.status_time = None
+
 
 class OsmScraper:
     """Functionality for querying the Overpass API."""
 
     def __init__(self, num_lat=5, num_lng=5, accept_all=False,
-                 tag_filter_objects=DEFAULT_TAG_FILTER_OBJECTS):
-        """Initialize the scraper."""
+                 tag_filter_objects=DEFAULT_TAG_FILTER_OBJECTS,
+                 adaptive=False, max_elements=2000, max_depth=8,
+                 workers=1, url=None, area=None, metrics=NULL_METRICS,
+                 tile_cache=None, tile_zoom=DEFAULT_TILE_ZOOM,
+                 streaming=False, keep_tags=None):
+        """Initialize the scraper.
+
+        :param num_lat: number of sub areas along the latitude
+        :param num_lng: number of sub areas along the longitude
+        :param tag_filter_objects: filters for the queried elements
+        :param adaptive: instead of a fixed grid, start with the whole area
+            and split an area into quadrants when its query times out or
+            returns more than max_elements elements
+        :param max_elements: maximum number of elements per query (adaptive)
+        :param max_depth: maximum number of splits of the area (adaptive)
+        :param workers: number of concurrent queries (they are scheduled
+            according to the free slots reported by the server)
+        :param url: url of the Overpass interpreter (default: overpy default)
+        :param area: optional geometry.Area; sub areas outside of it are not
+            queried and elements outside of it are dropped
+        :param metrics: Metrics of the queries (see metrics module)
+        :param tile_cache: optional cache.TileCache; the area is queried in
+            (slippy map) tiles instead of the grid and only tiles that are
+            not cached are queried (with adaptive, tiles with too many
+            elements are split into their four child tiles)
+        :param tile_zoom: zoom level of the tiles
+        :param streaming: parse the json responses element by element (see
+            stream_records) instead of building overpy results
+        :param keep_tags: only keep the tags needed for the google search and
+            these tags of the places (None: keep all tags)
+        """
         self.tag_filter_objects = tag_filter_objects
-        self.places = dict()
+        # ids of the places seen so far and the places not yielded yet
+        self.place_ids = set()
+        self.new_places = list()
         self.num_lat = num_lat
         self.num_lng = num_lng
-
-    def partial_tag_queries_from_item(self, item):
-        """Return disjunctive OverpassQL tag queries for a key, values pair."""
-        key, values = item
-        if values is None or len(values) == 0:
-            yield '["{}"]'.format(key)
-        elif isinstance(values, str):
-            yield '["{}"="{}"]'.format(key, values)
-        else:
-            for value in values:
-                yield '["{}"="{}"]'.format(key, value)
-
-    def tag_queries_from_object(self, obj):
-        """Return disjunctive chains of conjunctive tag queries."""
-        if len(obj) == 0:
-            yield ""
-        else:
-            obj = dict(obj)
-            for partial in self.partial_tag_queries_from_item(obj.popitem()):
-                for rest in self.tag_queries_from_object(obj):
-                    yield partial + rest
+        self.adaptive = adaptive
+        self.max_elements = max_elements
+        self.max_depth = max_depth
+        self.workers = workers
+        self.url = url
+        self.area = area
+        self.metrics = metrics
+        self.tile_cache = tile_cache
+        self.tile_zoom = tile_zoom
+        self.streaming = streaming
+        self.projection = tag_projection(keep_tags)
+        self.num_outside = 0
+        # elements outside of this box are dropped (the tiles cover more
+        # than the queried bounding box)
+        self.clip_box = None
 
     @property
     def tag_filters(self):
-        """Return all disjunctive chains of conjunctive tag queries."""
-        if self.tag_filter_objects is None or len(self.tag_filter_objects) == 0:
-            yield ""
-        else:
-            for obj in self.tag_filter_objects:
-                for tag_query in self.tag_queries_from_object(obj):
-                    yield tag_query
-
-    def build_query(self, bbox):
-        """Build an Overpass QL query for a given bounding box."""
-        bbox = ",".join([str(cc) for c in bbox for cc in c])
-
-        lines = list()
-        for query in self.tag_filters:
-            for element in ("node", "way"):
-                lines.append(
-                    "{element}{query}({bbox});".format(
-                        element=element,
-                        query=query,
-                        bbox=bbox,
-                    ))
-
-        return "(\n{}\n);\nout center;".format("\n".join(lines))
+        """Return the compiled tag filters (see query.compile_filters)."""
+        return compile_filters(self.tag_filter_objects)
+
+    def build_query(self, bbox, limit=None):
+        """Build an Overpass QL query for a given bounding box.
+
+        If limit is set, at most limit elements are returned.
+        """
+        return build_query(self.tag_filters, bbox, limit=limit)
 
     def sub_areas(self, bounding_box):
         """Return sub areas of bounding box.
@@ -89,64 +205,415 @@ class OsmScraper:
                     (min_lat + (i+1)*d_lat, min_lng + (j+1)*d_lng),
                 )
 
+    def split_area(self, bounding_box):
+        """Split an area into its four quadrants."""
+        (min_lat, min_lng), (max_lat, max_lng) = bounding_box
+
+        mid_lat = (min_lat + max_lat) / 2
+        mid_lng = (min_lng + max_lng) / 2
+
+        return [
+            ((min_lat, min_lng), (mid_lat, mid_lng)),
+            ((min_lat, mid_lng), (mid_lat, max_lng)),
+            ((mid_lat, min_lng), (max_lat, mid_lng)),
+            ((mid_lat, mid_lng), (max_lat, max_lng)),
+        ]
+
+    def initial_areas(self, bounding_box):
+        """Return the areas to start with (with their depth and tile)."""
+        if self.tile_cache is not None:
+            return [(tile_bounding_box(tile), 0, tile)
+                    for tile in tiles_in(bounding_box, self.tile_zoom)]
+        if self.adaptive:
+            return [(bounding_box, 0, None)]
+        return [(bb, 0, None) for bb in self.sub_areas(bounding_box)]
+
+    def split(self, bb, tile):
+        """Return the parts of an area (with their tile)."""
+        if tile is None:
+            return [(sub_area, None) for sub_area in self.split_area(bb)]
+        return [(tile_bounding_box(child), child)
+                for child in child_tiles(tile)]
+
+    def can_split(self, depth):
+        """Check whether an area of the given depth may be split."""
+        return self.adaptive and depth < self.max_depth
+
+    def query_area(self, api, slots, bb, depth):
+        """Query the elements in an area.
+
+        Waits for a free slot before each try and retries on errors.
+
+        :return: tuple (records, num_retries), records is None if the area
+            is too large and should be split instead
+        """
+        # only limit the result if the area can still be split,
+        # otherwise elements would be lost
+        limit = self.max_elements + 1 if self.can_split(depth) else None
+        query = self.build_query(bb, limit=limit)
+
+        metrics = self.metrics
+        num_retries = 0
+        sleep_time = 2
+        while True:
+            with metrics.timer("overpass_slot_wait_seconds"):
+                has_status = slots.acquire()
+            start = time.perf_counter()
+            try:
+                records = self.fetch_records(api, query)
+                metrics.observe("overpass_query_seconds",
+                                time.perf_counter() - start, outcome="ok")
+                return records, num_retries
+            except overpy.exception.OverpassTooManyRequests:
+                metrics.observe("overpass_query_seconds",
+                                time.perf_counter() - start,
+                                outcome="too_many_requests")
+                metrics.inc("overpass_retries_total",
+                            cause="too_many_requests")
+                # the next acquire waits for a free slot
+                if not has_status:
+                    # Sleep, then retry
+                    metrics.inc("overpass_backoff_seconds_total", sleep_time)
+                    sleep(sleep_time)
+                    sleep_time *= 2
+                num_retries += 1
+            except (
+                overpy.exception.OverpassGatewayTimeout,
+                overpy.exception.OverpassRuntimeError,
+            ) as e:
+                if (isinstance(e, overpy.exception.OverpassRuntimeError)
+                        and "timed out" not in e.msg
+                        and "out of memory" not in e.msg):
+                    raise
+                metrics.observe("overpass_query_seconds",
+                                time.perf_counter() - start,
+                                outcome="timeout")
+                if self.can_split(depth):
+                    # the area is too large, query the quadrants
+                    return None, num_retries
+                # Sleep, then retry
+                metrics.inc("overpass_retries_total", cause="timeout")
+                metrics.inc("overpass_backoff_seconds_total", sleep_time)
+                sleep(sleep_time)
+                sleep_time *= 2
+                num_retries += 1
+
+    def fetch_records(self, api, query):
+        """Send a query and return the records of its elements."""
+        if self.streaming:
+            return list(stream_records(api.url, query))
+        return element_records(api.query(query))
+
     def run(self, bounding_box):
         """Run scraper for a given bounding_box."""
-        api = overpy.Overpass()
+        return list(self.iter_run(bounding_box))
+
+    def iter_run(self, bounding_box):
+        """Run scraper for a given bounding_box and yield the places.
+
+        The places of an area are yielded as soon as its query is completed,
+        only their ids are kept (to drop duplicates). Closing the generator
+        early cancels the queries that have not been sent yet.
+        """
+        api = overpy.Overpass(url=self.url)
+        slots = OverpassSlots(api.url)
         num_retries = 0
-        with tqdm(self.sub_areas(bounding_box), unit="sub areas",
-                  total=self.num_lat*self.num_lng) as boxes:
-            for bb in boxes:
-                query = self.build_query(bb)
-
-                sleep_time = 2
-                while True:
-                    try:
-                        self.handle_response(api.query(query))
-                    except (
-                        overpy.exception.OverpassTooManyRequests,
-                        overpy.exception.OverpassGatewayTimeout
-                    ):
-                        # Sleep, then retry
-                        sleep(sleep_time)
-                        sleep_time *= 2
-                        num_retries += 1
-                    else:
-                        break
-                postfix = {"places": len(self.places), "retries": num_retries}
+        num_splits = 0
+        num_cached = 0
+
+        filter_key = None
+        if self.tile_cache is not None:
+            filter_key = self.tile_cache.filter_key(self.tag_filters)
+            self.clip_box = bounding_box
+
+        areas = deque(self.initial_areas(bounding_box))
+        pending = dict()
+
+        with tqdm(unit="sub areas", total=len(areas)) as boxes, \
+                ThreadPoolExecutor(max_workers=self.workers) as executor:
+
+            def complete(bb, depth, tile, records, too_large):
+                # results are merged in this thread only, so no locking of
+                # the places is needed
+                nonlocal num_splits
+                if records is not None:
+                    self.handle_records(records)
+
+                if too_large:
+                    areas.extend(
+                        (sub_area, depth + 1, sub_tile)
+                        for sub_area, sub_tile in self.split(bb, tile))
+                    boxes.total += 4
+                    num_splits += 1
+                    self.metrics.inc("overpass_splits_total")
+
+                boxes.update()
+                postfix = {"places": len(self.place_ids),
+                           "retries": num_retries}
+                if self.area is not None or self.clip_box is not None:
+                    postfix["outside"] = self.num_outside
+                if self.adaptive:
+                    postfix["splits"] = num_splits
+                if self.tile_cache is not None:
+                    postfix["cached"] = num_cached
                 boxes.set_postfix(postfix)
 
-        return list(self.places.values())
+                self.metrics.set("overpass_queue_depth", len(areas),
+                                 queue="areas")
+                self.metrics.set("overpass_queue_depth", len(pending),
+                                 queue="pending")
+                self.metrics.set("overpass_places", len(self.place_ids))
+                self.metrics.set("overpass_outside_places", self.num_outside)
+                self.metrics.maybe_flush()
+
+            try:
+                while areas or pending:
+                    while areas and len(pending) < self.workers:
+                        bb, depth, tile = areas.popleft()
+
+                        if (self.area is not None
+                                and not self.area.intersects(bb)):
+                            # nothing to query outside of the area
+                            boxes.update()
+                            continue
+
+                        if tile is not None:
+                            records = self.tile_cache.get(filter_key, tile)
+                            self.metrics.inc(
+                                "overpass_tile_cache_lookups_total",
+                                result="miss" if records is None else "hit")
+                            if records is not None:
+                                num_cached += 1
+                                if records == TILE_SPLIT:
+                                    complete(bb, depth, tile, None, True)
+                                else:
+                                    complete(bb, depth, tile, records, False)
+                                yield from self.pop_new_places()
+                                continue
+
+                        future = executor.submit(
+                            self.query_area, api, slots, bb, depth)
+                        pending[future] = (bb, depth, tile)
+
+                    if not pending:
+                        continue
+
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        bb, depth, tile = pending.pop(future)
+                        records, retries = future.result()
+                        num_retries += retries
+
+                        if records is not None:
+                            self.metrics.inc("overpass_elements_total",
+                                             len(records))
+
+                        too_large = records is None or (
+                            self.can_split(depth)
+                            and len(records) > self.max_elements)
+
+                        if tile is not None:
+                            # incomplete results are not cached, only that
+                            # the tile has to be split
+                            self.tile_cache.put(
+                                filter_key, tile,
+                                TILE_SPLIT if too_large else records)
+
+                        complete(bb, depth, tile, records, too_large)
+                        yield from self.pop_new_places()
+            finally:
+                # the generator may be closed early, the queries that have
+                # not been started yet are cancelled
+                for future in pending:
+                    future.cancel()
+                self.metrics.flush()
+
+        if self.tile_cache is not None:
+            self.tile_cache.evict()
+
+    def pop_new_places(self):
+        """Return the places added since the last call."""
+        places, self.new_places = self.new_places, list()
+        return places
 
     def handle_response(self, result):
         """Handle the response (for a queried subarea)."""
-        for way in result.ways:
-            if way.center_lat is None or way.center_lon is None:
-                print ("WARNING: Way without coords...")
-            else:
-                self.handle_element("way", way)
-        for node in result.nodes:
-            self.handle_element("node", node)
-
-    def handle_element(self, element_type, element):
+        self.handle_records(element_records(result))
+
+    def handle_records(self, records):
+        """Handle the records of the elements of a subarea."""
+        for record in records:
+            self.handle_record(record)
+
+    def handle_record(self, record):
         """Handle an observed element."""
-        if element_type == "way":
-            lat, lng = element.center_lat, element.center_lon
-        else:
-            lat, lng = element.lat, element.lon
+        lat, lng = record["lat"], record["lng"]
 
-        lat, lng = float(lat), float(lng)
+        if ((self.clip_box is not None
+             and not box_contains(self.clip_box, lat, lng))
+                or (self.area is not None
+                    and not self.area.contains(lat, lng))):
+            self.num_outside += 1
+            return
 
-        element_id = "{}/{}".format(element_type, element.id)
+        element_id = "{}/{}".format(record["type"], record["id"])
 
-        if element_id not in self.places:
-            self.places[element_id] = {
+        if element_id not in self.place_ids:
+            self.place_ids.add(element_id)
+            self.new_places.append({
                 "lat": lat,
                 "lng": lng,
                 "id": element_id,
-                "tags": element.tags,
-            }
+                "tags": project_tags(record["tags"], self.projection),
+            })
+
+
+def element_records(result):
+    """Return the records of the elements of an overpy result.
+
+    A record is a dict with the type, id, lat, lng and tags of an element.
+    """
+    records = list()
+    for way in result.ways:
+        if way.center_lat is None or way.center_lon is None:
+            print ("WARNING: Way without coords...")
+        else:
+            records.append(dict(type="way", id=way.id,
+                                lat=float(way.center_lat),
+                                lng=float(way.center_lon), tags=way.tags))
+    for node in result.nodes:
+        records.append(dict(type="node", id=node.id, lat=float(node.lat),
+                            lng=float(node.lon), tags=node.tags))
+    return records
+
+
+def json_record(element):
+    """Return the record of an element of an Overpass json response.
+
+    :return: the record or None for ways without a center (and relations)
+    """
+    if element.get("type") == "way":
+        center = element.get("center")
+        if center is None:
+            print ("WARNING: Way without coords...")
+            return None
+        lat, lng = center["lat"], center["lon"]
+    elif element.get("type") == "node":
+        lat, lng = element["lat"], element["lon"]
+    else:
+        return None
+
+    return dict(type=element["type"], id=element["id"], lat=float(lat),
+                lng=float(lng), tags=element.get("tags", {}))
+
+
+def raise_for_remark(text):
+    """Raise the overpy exception for a remark in (a part of) a response."""
+    remark = REMARK.search(text)
+    if remark is None:
+        return
+    msg = json.loads(remark.group(1)).strip()
+    if msg.startswith("runtime error:"):
+        raise overpy.exception.OverpassRuntimeError(msg=msg)
+    if msg.startswith("runtime remark:"):
+        raise overpy.exception.OverpassRuntimeRemark(msg=msg)
+    raise overpy.exception.OverpassUnknownError(msg=msg)
+
+
+def iter_json_elements(f, chunk_size=CHUNK_SIZE):
+    """Yield the elements of an Overpass json response one at a time.
+
+    Only the current chunk of the response is kept in memory, the remark of
+    the response (e.g. a runtime error) is raised after the last element.
+
+    :param f: binary file-like object of the response
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer, pos, eof = "", 0, False
+
+    def read():
+        nonlocal buffer, pos, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        # drop the parsed part of the buffer
+        buffer = buffer[pos:] + utf8.decode(chunk, final=eof)
+        pos = 0
+
+    # skip everything up to the start of the elements
+    while True:
+        start = re.search(r'"elements"\s*:\s*\[', buffer)
+        if start is not None:
+            raise_for_remark(buffer[:start.start()])
+            pos = start.end()
+            break
+        if eof:
+            raise_for_remark(buffer)
+            raise ValueError("Overpass response without elements.")
+        read()
+
+    while True:
+        # skip whitespace and separators between the elements
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                raise ValueError("Incomplete Overpass response.")
+            read()
+            continue
+        if buffer[pos] == "]":
+            break
+        try:
+            element, end = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            # the element continues in the next chunk
+            if eof:
+                raise
+            read()
+            continue
+        pos = end
+        yield element
+
+    # the rest of the response only contains the remark (if any)
+    while not eof:
+        read()
+    raise_for_remark(buffer[pos:])
+
+
+def stream_records(url, query, chunk_size=CHUNK_SIZE):
+    """Send a query and yield the records of its elements as they arrive.
+
+    Unlike overpy, the response is neither read completely nor turned into
+    objects; errors raise the same exceptions as overpy.Overpass.query.
+    """
+    # the output format is added to the settings of the query (a query can
+    # only have one settings statement)
+    settings = "[out:json]" if query.startswith("[") else "[out:json];\n"
+    data = (settings + query).encode("utf-8")
+    try:
+        f = urlopen(url, data)
+    except HTTPError as e:
+        if e.code == 400:
+            raise overpy.exception.OverpassBadRequest(data)
+        if e.code == 429:
+            raise overpy.exception.OverpassTooManyRequests()
+        if e.code == 504:
+            raise overpy.exception.OverpassGatewayTimeout()
+        raise overpy.exception.OverpassUnknownHTTPStatusCode(e.code)
+
+    with f:
+        for element in iter_json_elements(f, chunk_size):
+            record = json_record(element)
+            if record is not None:
+                yield record
 
 
 def run(bounding_box, **args):
     """Run OSM crawler for given bounding box in the given number of steps."""
     return OsmScraper(**args).run(bounding_box)
+
+
+def iter_run(bounding_box, **args):
+    """Run OSM crawler for given bounding box and yield the places."""
+    return OsmScraper(**args).iter_run(bounding_box)
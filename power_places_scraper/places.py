@@ -0,0 +1,47 @@
+"""Compact representation of the OSM places.
+
+The tags of a place can be projected onto the tags needed for the google
+search and its prioritization (and a user-chosen set of further tags). Keys
+and values of the tags are interned, so places with the same tags (e.g. the
+same street, city or opening hours) share their strings.
+"""
+
+import sys
+
+
+# tags the search string is built from (see google_scraper.get_search_string)
+FULL_ADDRESS_TAG = "addr:full"
+SEARCH_TAGS = ("name", "addr:street", "addr:housenumber", "addr:postcode",
+               "addr:city", "addr:province")
+
+# tags that determine the category of a place (the first one present, see
+# priority.place_category)
+CATEGORY_KEYS = ("amenity", "shop", "leisure", "tourism", "office", "craft")
+
+
+def tag_projection(keep_tags=None):
+    """Return the set of kept tags.
+
+    :param keep_tags: tags that are kept in addition to the search and
+        category tags (None: keep all tags)
+    :return: frozenset of tag keys or None if all tags are kept
+    """
+    if keep_tags is None:
+        return None
+    return frozenset(SEARCH_TAGS).union(
+        [FULL_ADDRESS_TAG], CATEGORY_KEYS, keep_tags)
+
+
+def project_tags(tags, projection=None):
+    """Return the tags of a projection with interned keys and values."""
+    return {
+        sys.intern(key): sys.intern(value) if isinstance(value, str)
+        else value
+        for key, value in tags.items()
+        if projection is None or key in projection
+    }
+
+
+def compact_place(place, projection=None):
+    """Return a place with projected (and interned) tags."""
+    return dict(place, tags=project_tags(place['tags'], projection))
@@ -0,0 +1,171 @@
+"""Compact representation of popular times and waiting times.
+
+The values of a week are kept in flat arrays of 7 * 24 values (monday 0:00
+first): popularity as uint8 and waiting times (in minutes) as uint16.
+Popularity data of many places can be exported into one binary file, which
+is loaded as one contiguous block per matrix type.
+"""
+
+import calendar
+import functools
+import json
+import re
+import struct
+import sys
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+DAY_NAMES = tuple(calendar.day_name)
+
+NUM_DAYS = 7
+NUM_HOURS = 24
+NUM_VALUES = NUM_DAYS * NUM_HOURS
+
+WAIT_DIGITS = re.compile(r'\d+')
+
+# magic bytes and version of the binary export
+MAGIC = b"PPSPOP1\n"
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_wait(wait_string):
+    """Convert a waiting time string (e.g. "15 min") into minutes."""
+    digits = WAIT_DIGITS.findall(wait_string)
+
+    if len(digits) == 0:
+        return 0
+    elif "min" in wait_string:
+        return int(digits[0])
+    elif "hour" in wait_string:
+        return int(digits[0]) * 60
+    else:
+        return int(digits[0]) * 60 + (int(digits[1]) if len(digits) > 1
+                                      else 0)
+
+
+def parse_popularity(popularity):
+    """Parse the popular times of a search response into flat arrays.
+
+    :param popularity: list of [day_no, hour_infos, ...] (day_no 1 is monday)
+    :return: tuple (popularity, waiting times) of arrays with 7 * 24 values
+    """
+    pop = array('B', bytes(NUM_VALUES))
+    wait = array('H', bytes(2 * NUM_VALUES))
+
+    for day in popularity:
+        day_no, pop_times = day[:2]
+
+        if not pop_times:
+            continue
+
+        offset = (day_no - 1) * NUM_HOURS
+        for hour_info in pop_times:
+            hour = hour_info[0]
+            pop[offset + hour] = hour_info[1] or 0
+
+            # check if the waiting string is available
+            if len(hour_info) > 5:
+                wait[offset + hour] = parse_wait(hour_info[3])
+
+            # day wrap
+            if hour == 23:
+                offset = (offset + NUM_HOURS) % NUM_VALUES
+
+    return pop, wait
+
+
+def to_day_dicts(values):
+    """Return {"name": <day>, "data": [...]} for each weekday."""
+    values = list(values)
+    return [
+        {
+            "name": DAY_NAMES[d],
+            "data": values[d * NUM_HOURS:(d + 1) * NUM_HOURS],
+        } for d in range(NUM_DAYS)
+    ]
+
+
+def to_array(values, typecode='B'):
+    """Convert popular or waiting times (verbose or flat) into an array."""
+    if values and isinstance(values[0], dict):
+        values = [v for day in values for v in day["data"]]
+    if not values:
+        return array(typecode, bytes(NUM_VALUES * array(typecode).itemsize))
+    return array(typecode, values)
+
+
+def write_popularity(places, path):
+    """Export the popular and waiting times of places into a binary file.
+
+    Only places with popular times are exported. The file consists of the
+    magic bytes, the length of the json header (uint32), the header (with
+    the osm ids of the places) and the popularity (uint8) and waiting
+    time (uint16) matrices of all places as contiguous blocks.
+
+    :return: number of exported places
+    """
+    ids = list()
+    pop = array('B')
+    wait = array('H')
+
+    for place in places:
+        google = place.get('google', {})
+        if not google.get('popular_times'):
+            continue
+        ids.append(place['osm']['id'])
+        pop.extend(to_array(google['popular_times'], 'B'))
+        wait.extend(to_array(google.get('waiting_times'), 'H'))
+
+    header = json.dumps(dict(
+        num_places=len(ids), days=NUM_DAYS, hours=NUM_HOURS, ids=ids,
+    )).encode("utf-8")
+
+    if sys.byteorder == 'big':
+        # the file is always little endian
+        wait.byteswap()
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        pop.tofile(f)
+        wait.tofile(f)
+
+    return len(ids)
+
+
+def load_popularity(path, as_numpy=False):
+    """Load the popular and waiting times exported by write_popularity.
+
+    :param as_numpy: return numpy arrays of shape (num_places, 7, 24)
+        instead of flat arrays (requires numpy)
+    :return: tuple (ids, popularity, waiting times)
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("'{}' is not a popularity export.".format(path))
+        header_length, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_length).decode("utf-8"))
+        data = f.read()
+
+    size = header['num_places'] * NUM_VALUES
+
+    if as_numpy:
+        if numpy is None:
+            raise ImportError("Loading the popularity as numpy arrays "
+                              "requires numpy (pip install numpy).")
+        shape = (header['num_places'], NUM_DAYS, NUM_HOURS)
+        pop = numpy.frombuffer(data, dtype=numpy.uint8, count=size)
+        wait = numpy.frombuffer(data, dtype='<u2', count=size, offset=size)
+        return header['ids'], pop.reshape(shape), wait.reshape(shape)
+
+    pop = array('B', data[:size])
+    wait = array('H', data[size:])
+    if sys.byteorder == 'big':
+        wait.byteswap()
+    return header['ids'], pop, wait
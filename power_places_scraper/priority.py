@@ -0,0 +1,186 @@
+"""Order of the google searches by their expected value.
+
+Places are grouped into categories by their main OSM tag (e.g.
+"amenity=cafe"). The probability that the search of a place finds popular
+times is estimated per category: it starts with a prior (cafés and bars
+usually have popular times, offices rarely do) and is updated with the
+results of the run. The scheduler hands out the place with the highest
+expected value next, so the valuable results arrive first and a limited
+budget of searches is spent on them. Every EXPLORE_EVERY-th search goes to
+the category with the fewest searches instead, until every category has
+been searched a few times.
+"""
+
+import heapq
+import threading
+
+from power_places_scraper.places import CATEGORY_KEYS
+
+
+# prior probability of popular times per tag key or key=value pair
+PRIOR_RATES = {
+    "amenity": 0.4,
+    "shop": 0.4,
+    "leisure": 0.3,
+    "tourism": 0.3,
+    "office": 0.05,
+    "craft": 0.1,
+    "amenity=bar": 0.7,
+    "amenity=cafe": 0.7,
+    "amenity=fast_food": 0.7,
+    "amenity=ice_cream": 0.6,
+    "amenity=pub": 0.7,
+    "amenity=restaurant": 0.7,
+    "amenity=cinema": 0.6,
+    "amenity=pharmacy": 0.5,
+    "amenity=fuel": 0.5,
+    "shop=supermarket": 0.8,
+    "shop=bakery": 0.6,
+    "shop=clothes": 0.5,
+    "shop=convenience": 0.5,
+    "leisure=fitness_centre": 0.6,
+    "tourism=museum": 0.6,
+}
+
+# prior probability of places without any of the category keys
+DEFAULT_RATE = 0.1
+
+# number of results the prior of a category counts as
+PRIOR_WEIGHT = 5
+
+# value of a search that only finds some information (no popular times)
+ANY_INFO_VALUE = 0.1
+
+# every n-th search explores a category with less than PRIOR_WEIGHT searches
+# (so categories with a wrong prior are not starved)
+EXPLORE_EVERY = 10
+
+
+def place_category(place):
+    """Return the category of a place (None if it has none)."""
+    tags = place['tags']
+    for key in CATEGORY_KEYS:
+        if key in tags:
+            return "{}={}".format(key, tags[key])
+    return None
+
+
+def prior_rate(category):
+    """Return the prior probability of popular times of a category."""
+    if category is None:
+        return DEFAULT_RATE
+    if category in PRIOR_RATES:
+        return PRIOR_RATES[category]
+    return PRIOR_RATES.get(category.split("=", 1)[0], DEFAULT_RATE)
+
+
+class HitRates:
+    """Estimated hit rates of the categories (learned during a run)."""
+
+    def __init__(self):
+        """Initialize without any results."""
+        # number of results, with popular times, with any information
+        self.counts = dict()
+
+    def value(self, category):
+        """Return the expected value of searching a place of a category.
+
+        The probabilities of popular times and of any information are
+        smoothed with the prior (counting as PRIOR_WEIGHT results).
+        """
+        prior = prior_rate(category)
+        num, popular, any_info = self.counts.get(category, (0, 0, 0))
+        p_popular = (popular + prior * PRIOR_WEIGHT) / (num + PRIOR_WEIGHT)
+        p_any = (any_info + PRIOR_WEIGHT) / (num + PRIOR_WEIGHT)
+        return p_popular + ANY_INFO_VALUE * p_any
+
+    def record(self, category, popular, any_info):
+        """Add the result of a search."""
+        num, num_popular, num_any = self.counts.get(category, (0, 0, 0))
+        self.counts[category] = (num + 1, num_popular + bool(popular),
+                                 num_any + bool(any_info))
+
+
+class PriorityScheduler:
+    """Hand out places by their expected value.
+
+    The values of the categories change with every recorded result, so the
+    order is decided when a place is handed out: each category keeps a queue
+    of its places (by weight) and the category whose first place has the
+    highest value is taken (or the least searched one, see EXPLORE_EVERY).
+    """
+
+    def __init__(self, places, weight=None, budget=None, rates=None):
+        """Initialize the scheduler.
+
+        :param places: places to search
+        :param weight: function returning the number of places a search
+            counts for (e.g. the size of its group, default: 1)
+        :param budget: maximum number of places handed out (None: all)
+        :param rates: HitRates (default: new ones)
+        """
+        self.queues = dict()
+        for i, place in enumerate(places):
+            w = weight(place) if weight is not None else 1
+            heapq.heappush(self.queues.setdefault(place_category(place), []),
+                           (-w, i, place))
+        self.budget = budget
+        self.rates = rates if rates is not None else HitRates()
+        self.num_scheduled = 0
+        # number of places handed out per category
+        self.num_searches = dict()
+        # places are handed out and results recorded in different threads
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        """Return the number of places that are still queued."""
+        return sum(len(queue) for queue in self.queues.values())
+
+    def next_place(self):
+        """Return the place with the highest expected value.
+
+        :return: the place or None if all places (or the budget) are spent
+        """
+        with self.lock:
+            if self.budget is not None and self.num_scheduled >= self.budget:
+                return None
+
+            if not self.queues:
+                return None
+
+            def value(category):
+                weight = -self.queues[category][0][0]
+                return self.rates.value(category) * weight
+
+            best = None
+            if self.num_scheduled % EXPLORE_EVERY == EXPLORE_EVERY - 1:
+                unexplored = [c for c in self.queues
+                              if self.num_searches.get(c, 0) < PRIOR_WEIGHT]
+                if unexplored:
+                    best = min(unexplored, key=lambda c: (
+                        self.num_searches.get(c, 0), -value(c)))
+            if best is None:
+                best = max(self.queues, key=value)
+
+            _, _, place = heapq.heappop(self.queues[best])
+            if not self.queues[best]:
+                del self.queues[best]
+
+            self.num_searches[best] = self.num_searches.get(best, 0) + 1
+            self.num_scheduled += 1
+            return place
+
+    def __iter__(self):
+        """Yield the places in the order of their expected value."""
+        while True:
+            place = self.next_place()
+            if place is None:
+                return
+            yield place
+
+    def record(self, place, google):
+        """Record the result of the search of a place."""
+        with self.lock:
+            self.rates.record(place_category(place),
+                              'popular_times' in google,
+                              google['search_info']['any_info'])
@@ -0,0 +1,167 @@
+"""Compilation of tag filters into compact Overpass QL queries.
+
+The tag filter objects are a disjunction of conjunctions: every object maps
+keys to None (the key has to exist), a value or a list of values (the key
+has one of them). The compiler turns them into as few statements as
+possible:
+
+- clauses that only differ in the values of one key are merged, lists of
+  values become a regular expression (["amenity"~"^(bar|cafe)$"])
+- clauses that are subsumed by a more general clause are dropped
+- nodes and ways are selected by one statement (nw) per clause and the
+  bounding box is a global setting instead of being repeated
+
+The compiled filters only depend on the filter objects and are cached.
+"""
+
+import functools
+import json
+
+
+# characters with a special meaning in (POSIX extended) regular expressions
+REGEX_SPECIAL = set(".[]{}()\\*+?^$|")
+
+
+def quote(text):
+    """Return a string literal of Overpass QL."""
+    return '"{}"'.format(text.replace("\\", "\\\\").replace('"', '\\"'))
+
+
+def regex_escape(value):
+    """Escape the special characters of a regular expression."""
+    return "".join("\\" + c if c in REGEX_SPECIAL else c for c in value)
+
+
+def clause_from_object(obj):
+    """Return the clause of a tag filter object.
+
+    :return: frozenset of conditions (key, values), values is None if the key
+        only has to exist or a frozenset of the allowed values
+    """
+    conditions = list()
+    for key, values in obj.items():
+        if values is None or len(values) == 0:
+            conditions.append((key, None))
+        elif isinstance(values, str):
+            conditions.append((key, frozenset([values])))
+        else:
+            conditions.append((key, frozenset(values)))
+    return frozenset(conditions)
+
+
+def subsumes(general, special):
+    """Check whether every element matching special also matches general."""
+    special = dict(special)
+    for key, values in general:
+        if key not in special:
+            return False
+        if values is not None and (special[key] is None
+                                   or not special[key] <= values):
+            return False
+    return True
+
+
+def merge_clauses(a, b):
+    """Merge two clauses that only differ in the values of one key.
+
+    :return: the merged clause or None if they cannot be merged
+    """
+    a, b = dict(a), dict(b)
+    if a.keys() != b.keys():
+        return None
+    different = [key for key in a if a[key] != b[key]]
+    if len(different) != 1:
+        return None
+    key = different[0]
+    if a[key] is None or b[key] is None:
+        # one of them subsumes the other
+        return None
+    a[key] = a[key] | b[key]
+    return frozenset(a.items())
+
+
+def optimize_clauses(clauses):
+    """Merge clauses and drop subsumed ones (until nothing changes)."""
+    clauses = list(dict.fromkeys(clauses))
+    changed = True
+    while changed:
+        changed = False
+
+        for i, a in enumerate(clauses):
+            for j in range(i + 1, len(clauses)):
+                merged = merge_clauses(a, clauses[j])
+                if merged is not None:
+                    del clauses[j]
+                    clauses[i] = merged
+                    changed = True
+                    break
+            if changed:
+                break
+
+        remaining = list()
+        for i, clause in enumerate(clauses):
+            # of equal clauses, only the first one is kept
+            if any(subsumes(other, clause)
+                   and (j < i or not subsumes(clause, other))
+                   for j, other in enumerate(clauses) if j != i):
+                changed = True
+            else:
+                remaining.append(clause)
+        clauses = remaining
+
+    return clauses
+
+
+def format_condition(key, values):
+    """Return the Overpass QL filter of a condition."""
+    if values is None:
+        return "[{}]".format(quote(key))
+    if len(values) == 1:
+        return "[{}={}]".format(quote(key), quote(next(iter(values))))
+    pattern = "^({})$".format("|".join(
+        regex_escape(value) for value in sorted(values)))
+    return "[{}~{}]".format(quote(key), quote(pattern))
+
+
+def format_clause(clause):
+    """Return the Overpass QL filters of a clause (sorted by key)."""
+    return "".join(format_condition(key, values)
+                   for key, values in sorted(clause, key=lambda c: c[0]))
+
+
+@functools.lru_cache(maxsize=32)
+def compile_filters_cached(key):
+    """Compile the tag filter objects given as canonical json."""
+    objects = json.loads(key)
+    if not objects:
+        # no filters select all elements
+        return ("",)
+    clauses = optimize_clauses(clause_from_object(obj) for obj in objects)
+    return tuple(sorted(format_clause(clause) for clause in clauses))
+
+
+def compile_filters(tag_filter_objects):
+    """Return the Overpass QL tag filters of the tag filter objects.
+
+    :return: tuple of filter strings (one per statement)
+    """
+    return compile_filters_cached(
+        json.dumps(tag_filter_objects or [], sort_keys=True))
+
+
+def build_query(tag_filters, bbox, limit=None):
+    """Build an Overpass QL query for the elements in a bounding box.
+
+    :param tag_filters: compiled tag filters (see compile_filters)
+    :param bbox: bounding box ((south, west), (north, east))
+    :param limit: if set, at most limit elements are returned
+    """
+    bbox = ",".join([str(cc) for c in bbox for cc in c])
+    lines = ["nw{};".format(tag_filter) for tag_filter in tag_filters]
+
+    if limit is None:
+        out = "out center;"
+    else:
+        out = "out center {};".format(limit)
+
+    return "[bbox:{}];\n(\n{}\n);\n{}".format(bbox, "\n".join(lines), out)
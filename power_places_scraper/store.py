@@ -0,0 +1,385 @@
+"""Append-only time-series store of popularity observations.
+
+A store is a directory. The ids of the observed places are listed in
+places.txt (the line number is the number of a place). The observations are
+appended to segments of fixed-width little endian records:
+
+- <n>.obs: number of the place (uint32), time (unix seconds, uint32) and
+  current popularity (int16, -1 if not available)
+- <n>.weekly: number of the place, time and the weekly popularity matrix
+  (7 * 24 uint8 values, see popularity module), only if the store keeps them
+- <n>.idx: written when a segment is sealed, the number of records, the
+  first and last time of the segment and a (place number, record number)
+  pair for every record, sorted by place
+
+Every writer starts a new segment and seals it when it is closed (or the
+segment is full), so existing segments are never modified. Segments are read
+via mmap: the index is searched for the records of a place, segments outside
+of a time range are skipped.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+
+from power_places_scraper.popularity import to_array, NUM_VALUES
+
+
+OBSERVATION = struct.Struct('<IIh')
+WEEKLY = struct.Struct('<II{}s'.format(NUM_VALUES))
+INDEX_HEADER = struct.Struct('<III')
+INDEX_ENTRY = struct.Struct('<II')
+
+# magic bytes and version at the start of the segment files
+MAGIC_OBSERVATIONS = b"PPSOBS1\n"
+MAGIC_WEEKLY = b"PPSWKL1\n"
+MAGIC_INDEX = b"PPSIDX1\n"
+HEADER_SIZE = 8
+
+# maximum number of observations per segment (about 10 MB)
+DEFAULT_SEGMENT_SIZE = 1000000
+
+# current popularity of observations without one
+MISSING = -1
+
+
+def map_file(path, magic):
+    """Map a segment file into memory.
+
+    :return: the mmap or None if the file does not contain any records
+    """
+    if not os.path.exists(path) or os.path.getsize(path) <= HEADER_SIZE:
+        return None
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if data[:HEADER_SIZE] != magic:
+        data.close()
+        raise ValueError("'{}' is not a segment of a store.".format(path))
+    return data
+
+
+class Segment:
+    """A segment of a store (read only)."""
+
+    def __init__(self, path, number):
+        """Map the files of a segment.
+
+        :param path: path of the store
+        :param number: number of the segment
+        """
+        def segment_path(kind):
+            return os.path.join(path, "{:06d}.{}".format(number, kind))
+
+        self.number = number
+        self.observations = map_file(segment_path("obs"),
+                                     MAGIC_OBSERVATIONS)
+        self.weekly = map_file(segment_path("weekly"), MAGIC_WEEKLY)
+        self.index = map_file(segment_path("idx"), MAGIC_INDEX)
+
+        # a segment that is still written (or whose writer crashed) may end
+        # with an incomplete record
+        size = 0 if self.observations is None else len(self.observations)
+        self.num_records = max(0, size - HEADER_SIZE) // OBSERVATION.size
+
+        if self.index is not None:
+            self.num_records, self.first_time, self.last_time = \
+                INDEX_HEADER.unpack_from(self.index, HEADER_SIZE)
+        else:
+            times = [t for _, t, _ in self.iter_records()]
+            self.first_time = min(times, default=None)
+            self.last_time = max(times, default=None)
+
+    def close(self):
+        """Unmap the files of the segment."""
+        for data in (self.observations, self.weekly, self.index):
+            if data is not None:
+                data.close()
+
+    def record(self, record_no):
+        """Return an observation (place number, time, current popularity)."""
+        return OBSERVATION.unpack_from(
+            self.observations, HEADER_SIZE + record_no * OBSERVATION.size)
+
+    def iter_records(self):
+        """Yield all observations of the segment in the order of appending."""
+        if self.num_records == 0:
+            return
+        end = HEADER_SIZE + self.num_records * OBSERVATION.size
+        yield from OBSERVATION.iter_unpack(
+            memoryview(self.observations)[HEADER_SIZE:end])
+
+    def overlaps(self, start=None, end=None):
+        """Check whether the segment has observations in a time range."""
+        if self.first_time is None:
+            return False
+        return ((start is None or self.last_time >= start)
+                and (end is None or self.first_time < end))
+
+    def iter_place(self, place_no):
+        """Yield the observations of a place."""
+        if self.index is None:
+            for record in self.iter_records():
+                if record[0] == place_no:
+                    yield record
+            return
+
+        offset = HEADER_SIZE + INDEX_HEADER.size
+
+        def entry(i):
+            return INDEX_ENTRY.unpack_from(
+                self.index, offset + i * INDEX_ENTRY.size)
+
+        # binary search for the first entry of the place
+        low, high = 0, self.num_records
+        while low < high:
+            middle = (low + high) // 2
+            if entry(middle)[0] < place_no:
+                low = middle + 1
+            else:
+                high = middle
+
+        for i in range(low, self.num_records):
+            entry_place_no, record_no = entry(i)
+            if entry_place_no != place_no:
+                break
+            yield self.record(record_no)
+
+    def iter_weekly(self):
+        """Yield the weekly matrices (place number, time, bytes)."""
+        if self.weekly is None:
+            return
+        num = (len(self.weekly) - HEADER_SIZE) // WEEKLY.size
+        end = HEADER_SIZE + num * WEEKLY.size
+        yield from WEEKLY.iter_unpack(
+            memoryview(self.weekly)[HEADER_SIZE:end])
+
+
+class ObservationStore:
+    """Append observations to a store and read them."""
+
+    def __init__(self, path, weekly=False,
+                 segment_size=DEFAULT_SEGMENT_SIZE):
+        """Open (or create) a store.
+
+        :param path: path of the directory of the store
+        :param weekly: keep the weekly popularity matrices of the
+            observations
+        :param segment_size: maximum number of observations per segment
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.weekly = weekly
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+
+        self.place_ids = list()
+        self.place_numbers = dict()
+        self.load_places()
+        self.places_file = None
+
+        self.files = None
+        self.segment = None
+
+    def load_places(self):
+        """Load the places added since the last call (e.g. by a writer)."""
+        places_path = os.path.join(self.path, "places.txt")
+        if not os.path.exists(places_path):
+            return
+        with open(places_path, 'r') as f:
+            for i, line in enumerate(f):
+                # the last line may still be written
+                if i >= len(self.place_ids) and line.endswith("\n"):
+                    self.add_place(line[:-1])
+
+    def add_place(self, place_id):
+        """Add the id of a place to the list of places (in memory)."""
+        self.place_numbers[place_id] = len(self.place_ids)
+        self.place_ids.append(place_id)
+
+    def segment_numbers(self):
+        """Return the numbers of the segments (sorted)."""
+        return sorted(int(name.split(".")[0])
+                      for name in os.listdir(self.path)
+                      if name.endswith(".obs"))
+
+    def segment_path(self, number, kind):
+        """Return the path of a file of a segment."""
+        return os.path.join(self.path, "{:06d}.{}".format(number, kind))
+
+    def place_number(self, place_id):
+        """Return the number of a place (a new place is added)."""
+        if place_id not in self.place_numbers:
+            if "\n" in place_id:
+                raise ValueError("Invalid place id {!r}.".format(place_id))
+            if self.places_file is None:
+                self.places_file = open(
+                    os.path.join(self.path, "places.txt"), 'a')
+            self.places_file.write(place_id + "\n")
+            self.add_place(place_id)
+        return self.place_numbers[place_id]
+
+    def start_segment(self):
+        """Start a new segment."""
+        numbers = self.segment_numbers()
+        self.segment = (numbers[-1] + 1) if numbers else 1
+        self.files = dict(obs=open(self.segment_path(self.segment, "obs"),
+                                   'xb'))
+        self.files['obs'].write(MAGIC_OBSERVATIONS)
+        if self.weekly:
+            self.files['weekly'] = open(
+                self.segment_path(self.segment, "weekly"), 'xb')
+            self.files['weekly'].write(MAGIC_WEEKLY)
+        self.entries = array('I')
+        self.first_time, self.last_time = None, None
+
+    def append(self, place_id, timestamp, current_popularity,
+               popular_times=None):
+        """Append an observation of a place.
+
+        :param place_id: id of the place (e.g. the google place_id)
+        :param timestamp: unix time of the observation
+        :param current_popularity: current popularity or None
+        :param popular_times: popular times of the place (verbose or
+            compact), only kept if the store keeps the weekly matrices
+        """
+        with self.lock:
+            if self.files is None:
+                self.start_segment()
+            elif len(self.entries) // 2 >= self.segment_size:
+                self.seal()
+                self.start_segment()
+
+            place_no = self.place_number(place_id)
+            timestamp = int(timestamp)
+            record_no = len(self.entries) // 2
+
+            self.files['obs'].write(OBSERVATION.pack(
+                place_no, timestamp,
+                MISSING if current_popularity is None
+                else current_popularity))
+            self.entries.extend((place_no, record_no))
+
+            if self.first_time is None:
+                self.first_time, self.last_time = timestamp, timestamp
+            else:
+                self.first_time = min(self.first_time, timestamp)
+                self.last_time = max(self.last_time, timestamp)
+
+            if self.weekly and popular_times:
+                self.files['weekly'].write(WEEKLY.pack(
+                    place_no, timestamp,
+                    to_array(popular_times, 'B').tobytes()))
+
+    def flush(self):
+        """Write the buffered observations to the segment files."""
+        with self.lock:
+            if self.places_file is not None:
+                self.places_file.flush()
+            for f in (self.files or {}).values():
+                f.flush()
+
+    def seal(self):
+        """Close the current segment and write its index."""
+        if self.files is None:
+            return
+
+        if self.places_file is not None:
+            self.places_file.flush()
+        for f in self.files.values():
+            f.close()
+
+        num_records = len(self.entries) // 2
+        pairs = sorted(zip(self.entries[0::2], self.entries[1::2]))
+
+        index = array('I')
+        for pair in pairs:
+            index.extend(pair)
+        if sys.byteorder == 'big':
+            # the files are always little endian
+            index.byteswap()
+
+        tmp_path = self.segment_path(self.segment, "idx.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC_INDEX)
+            f.write(INDEX_HEADER.pack(num_records, self.first_time or 0,
+                                      self.last_time or 0))
+            index.tofile(f)
+        os.replace(tmp_path, self.segment_path(self.segment, "idx"))
+
+        self.files = None
+
+    def close(self):
+        """Seal the current segment."""
+        with self.lock:
+            self.seal()
+            if self.places_file is not None:
+                self.places_file.close()
+                self.places_file = None
+
+    def __enter__(self):
+        """Use the store as a context manager."""
+        return self
+
+    def __exit__(self, *args):
+        """Seal the current segment."""
+        self.close()
+
+    def iter_segments(self, start=None, end=None):
+        """Yield the segments with observations in a time range."""
+        self.flush()
+        self.load_places()
+        for number in self.segment_numbers():
+            segment = Segment(self.path, number)
+            try:
+                if segment.overlaps(start, end):
+                    yield segment
+            finally:
+                segment.close()
+
+    def read_place(self, place_id, start=None, end=None):
+        """Return the observations of a place in a time range.
+
+        :param start: first time (inclusive, None: from the beginning)
+        :param end: last time (exclusive, None: until the end)
+        :return: list of tuples (time, current popularity) sorted by time
+        """
+        if place_id not in self.place_numbers:
+            return []
+        place_no = self.place_numbers[place_id]
+
+        observations = list()
+        for segment in self.iter_segments(start, end):
+            for _, timestamp, value in segment.iter_place(place_no):
+                if ((start is None or timestamp >= start)
+                        and (end is None or timestamp < end)):
+                    observations.append(
+                        (timestamp, None if value == MISSING else value))
+        observations.sort(key=lambda o: o[0])
+        return observations
+
+    def iter_range(self, start=None, end=None):
+        """Yield all observations in a time range.
+
+        :return: generator of tuples (place id, time, current popularity)
+            in the order they were appended
+        """
+        for segment in self.iter_segments(start, end):
+            for place_no, timestamp, value in segment.iter_records():
+                if ((start is None or timestamp >= start)
+                        and (end is None or timestamp < end)):
+                    yield (self.place_ids[place_no], timestamp,
+                           None if value == MISSING else value)
+
+    def read_weekly(self, place_id):
+        """Return the weekly popularity matrices of a place.
+
+        :return: list of tuples (time, array of 7 * 24 values)
+        """
+        place_no = self.place_numbers.get(place_id)
+        return [(timestamp, array('B', matrix))
+                for segment in self.iter_segments()
+                for number, timestamp, matrix in segment.iter_weekly()
+                if number == place_no]
@@ -5,7 +5,10 @@ import requests
 import geojson
 
 import datetime
-import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from power_places_scraper.geometry import Area, polygons_from_geojson
 
 
 
@@ -26,19 +29,37 @@ def get_external_ip(proxies=None):
         return r.json()["ip"]
 
 
+def check_proxies(urls):
+    """Test the connection via each proxy url.
+
+    :return: dict with the external ip of each working proxy by url
+    """
+    def check(url):
+        try:
+            return get_external_ip(proxies=dict(http=url, https=url))
+        except (IOError, ValueError):
+            return False
+
+    with ThreadPoolExecutor(max_workers=min(32, len(urls) or 1)) as executor:
+        ips = list(executor.map(check, urls))
+
+    return {url: ip for url, ip in zip(urls, ips) if ip}
+
+
 def load_bounding_box(path):
     """Get a boundin box from a geojson file."""
     with open(path, 'r') as f:
         geo_json = geojson.load(f)
 
-        for k in ("features", 0, "geometry", "coordinates", 0):
-            try:
-                geo_json = geo_json[k]
-            except (IndexError, KeyError):
-                print ("Area file invalid.")
-                return None
-
-        lngs, lats = zip(*geo_json)
+        try:
+            # outlines of all (multi)polygons
+            positions = [position
+                         for polygon in polygons_from_geojson(geo_json)
+                         for position in polygon[0]]
+            lngs, lats = list(zip(*positions))[:2]
+        except (IndexError, KeyError, TypeError, ValueError):
+            print ("Area file invalid.")
+            return None
 
         south = min(lats)
         west = min(lngs)
@@ -58,3 +79,73 @@ def load_bounding_box(path):
             west -= 360
 
         return ((south, west), (north, east))
+
+
+def load_area(path):
+    """Get the (multi)polygon area from a geojson file."""
+    with open(path, 'r') as f:
+        geo_json = geojson.load(f)
+
+    try:
+        area = Area.from_geojson(geo_json)
+    except (IndexError, KeyError, TypeError, ValueError):
+        print ("Area file invalid.")
+        return None
+
+    if not area.polygons:
+        print ("Area file invalid.")
+        return None
+
+    (_, west), (_, east) = area.bounding_box
+    if east - west > 180:
+        # polygons across the antimeridian are not supported, the bounding
+        # box is used instead
+        print("Area contains anitmeridian.")
+        return None
+
+    return area
+
+
+def iter_ndjson(path):
+    """Lazily read records from a line-delimited json file."""
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def write_ndjson(records, path):
+    """Write records to a line-delimited json file one at a time.
+
+    :return: number of written records
+    """
+    num_records = 0
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record))
+            f.write("\n")
+            # flush every record, so an interrupted run keeps its results
+            f.flush()
+            num_records += 1
+    return num_records
+
+
+def meta_path(path):
+    """Return the path of the sidecar file with the metadata of a run."""
+    return path + ".meta.json"
+
+
+def load_meta(path):
+    """Load the metadata of a line-delimited json file (if available)."""
+    try:
+        with open(meta_path(path), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict()
+
+
+def save_meta(meta, path):
+    """Save the metadata of a line-delimited json file."""
+    with open(meta_path(path), 'w') as f:
+        json.dump(meta, f)
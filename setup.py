@@ -38,4 +38,10 @@ setup(
     install_requires=[
         "geojson", "overpy", "PySocks", "tqdm", "requests"
     ],
+
+    # Optional dependencies
+    extras_require={
+        # asyncio engine for the google search scraping
+        "async": ["aiohttp", "aiohttp-socks"],
+    },
 )
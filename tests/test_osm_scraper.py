@@ -0,0 +1,34 @@
+import os
+import tempfile
+import unittest
+
+from power_places_scraper.cache import TileCache
+from power_places_scraper.geometry import tiles_in
+from power_places_scraper.osm_scraper import OsmScraper
+
+
+class TileClippingTest(unittest.TestCase):
+
+    def test_cached_tiles_are_clipped_to_bounding_box(self):
+        bounding_box = ((52.50, 13.36), (52.501, 13.361))
+        inside = dict(type="node", id=1, lat=52.5005, lng=13.3605,
+                      tags={"name": "inside", "addr:street": "A"})
+        outside = dict(type="node", id=2, lat=52.4838, lng=13.3605,
+                       tags={"name": "outside", "addr:street": "B"})
+
+        with tempfile.TemporaryDirectory() as path:
+            cache = TileCache(os.path.join(path, "cache.sqlite"))
+            scraper = OsmScraper(tile_cache=cache)
+            filter_key = cache.filter_key(scraper.tag_filters)
+            # every tile is cached, so nothing is queried
+            for tile in tiles_in(bounding_box, scraper.tile_zoom):
+                cache.put(filter_key, tile, [inside, outside])
+
+            places = scraper.run(bounding_box)
+
+        self.assertEqual([place["id"] for place in places], ["node/1"])
+        self.assertEqual(scraper.num_outside, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()